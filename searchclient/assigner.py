@@ -56,8 +56,8 @@ class Goal:
 
 
 class GoalsGraph:
-    def __init__(self, tasks, agent_position) -> None:
-        path_utils = PathUtils(State.walls)
+    def __init__(self, tasks, agent_position, walls) -> None:
+        path_utils = PathUtils(walls)
         self.nodes = dict()
         start = Goal("start", None)
         finish = Goal("finish", None)
@@ -101,21 +101,24 @@ class GoalsGraph:
 
 
 class Assigner:
-    def __init__(self, initial_state: State) -> None:
+    def __init__(self, initial_state: State, distances) -> None:
         self.state = initial_state
+        # DistanceTable or DistanceOracle of the level, which also tells what the agents can reach.
+        self.distances = distances
 
     def assign_tasks_to_agent(self, agent) -> tuple:
-        n_rows, n_cols = len(self.state._goals), len(self.state._goals[0])
-        agent_color = State.agent_colors[agent]
-        letters = [chr(ord('A') + i) for i in range(26) if self.state.box_colors[i] == agent_color]
-        floodfill = PathUtils(State.walls)
-        reachability_map = floodfill.get_reachability_map((self.state.agent_rows[agent], self.state.agent_cols[agent]))
+        level = self.state.level
+        agent_color = level.agent_colors[agent]
+        letters = [chr(ord('A') + i) for i in range(26) if level.box_colors[i] == agent_color]
+        agent_cell = self.state.agents[agent]
+        def reachable(cell):
+            return self.distances.distance(agent_cell, cell) is not None
         boxes = {}
         for letter in letters:
-            boxes[letter] = [(row, col) for row in range(n_rows) for col in range(n_cols) if self.state.boxes[row][col] == letter and reachability_map[row][col]]
+            boxes[letter] = [level.positions[cell] for cell, box in zip(self.state.box_cells, self.state.box_letters) if box == letter and reachable(cell)]
         goals = {}
         for letter in letters + [chr(ord('0') + agent)]:
-            goals[letter] = [(row, col) for row in range(n_rows) for col in range(n_cols) if self.state._goals[row][col] == letter and reachability_map[row][col]]
+            goals[letter] = [level.positions[cell] for cell in level.goals_by_letter.get(letter, ()) if reachable(cell)]
 
         # print(f"Agent {agent} boxes: {boxes}", file=stderr, flush=True)
         # print(f"Agent {agent} goals: {goals}", file=stderr, flush=True)
@@ -123,10 +126,10 @@ class Assigner:
 
     def get_graph(self, agent) -> GoalsGraph:
         tasks = self.assign_tasks_to_agent(agent)[1]
-        agent_position = (self.state.agent_rows[agent], self.state.agent_cols[agent])
-        graph = GoalsGraph(tasks, agent_position)
+        agent_position = self.state.level.positions[self.state.agents[agent]]
+        graph = GoalsGraph(tasks, agent_position, self.state.level.wall_rows())
         # print(graph.nodes, file=stderr, flush=True)
         return graph
 
     def assign_plans(self) -> list:
-        return [self.get_graph(agent).get_order() for agent in range(len(self.state.agent_rows))]
+        return [self.get_graph(agent).get_order() for agent in range(len(self.state.agents))]
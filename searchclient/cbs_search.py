@@ -1,41 +1,75 @@
-import copy
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
 import sys
 import traceback
 
-from graphsearch import search
+import memory
+
+from graphsearch import search, ida_search, sipp_search
 from frontier import FrontierBestFirst, CBSQueue
 from heuristic import HeuristicDijkstra
 from state import State
 from action import Action
-from conflict import Conflict
-from preprocessing import Preprocessor, Dijkstra
-from assigner import Assigner, PathUtils
+from conflict import Conflict, ReservationTable
+from preprocessing import Preprocessor, distances, components
+from assigner import Assigner
+from mdd import MDD
+
+# The single-agent search of the low level, "astar", "idastar" or "sipp" (meta-agents use astar instead of sipp).
+low_level = "astar"
+# Conflicts between two agents after which cbs_search plans them jointly as a meta-agent, negative to never merge.
+merge_threshold = 10
+# Processes running the low-level searches, see LowLevelPool. 1 to search in this process only.
+workers = 1
 
 
 class Root:
     initial_state = None
+    # ReservationTable of the CBS run, brought up to date with the solution of each node as it is examined.
+    reservations = None
 
     def __init__(self, num_agents, count=0):
+        # The plan, constraints and meta-agent of every agent are tuples that children share with their parent,
+        # see child. The meta-agent of an agent is the sorted tuple of the agents planned jointly with it.
         self.count = count
-        self.solution = []
+        self.solution = ()
         self.cost = 0
-        self.constraints = [set() for _ in range(num_agents)]
+        self.constraints = tuple(frozenset() for _ in range(num_agents))
+        self.groups = tuple((agent,) for agent in range(num_agents))
+
+    def child(self, count, plans, constraints=None, group=None) -> "Root":
+        """
+        The node in which the agents of plans (agent -> plan) and constraints (agent -> constraints) have these
+        instead, and the agents of group, if given, form a meta-agent. Only these entries are new, the other agents'
+        are shared with this node.
+        """
+        node = Root.__new__(Root)
+        node.count = count
+        node.cost = 0
+        node.solution = Root._replace(self.solution, plans)
+        node.constraints = Root._replace(self.constraints, constraints)
+        node.groups = self.groups if group is None else Root._replace(self.groups, {agent: group for agent in group})
+        return node
+
+    @staticmethod
+    def _replace(entries, changes):
+        if not changes:
+            return entries
+        entries = list(entries)
+        for agent, entry in changes.items():
+            entries[agent] = entry
+        return tuple(entries)
+
+    def get_conflicts(self) -> "[Conflict, ...]":
+        """All conflicts between the plans of the solution, earliest first."""
+        self.reservations.update(self.solution)
+        return self.reservations.conflicts()
 
     def get_conflict(self) -> "Conflict":
-        longest_plan = len(max(self.solution, key=len))
-        state = copy.deepcopy(self.initial_state)
-        for step in range(longest_plan):
-            joint_action = []
-            for agent, _ in enumerate(self.solution):
-                try:
-                    action = self.solution[agent][step]
-                except IndexError:
-                    action = [Action.NoOp]
-                joint_action = joint_action + action
-            conflicts = state.is_conflict(joint_action, state.t)
-            if conflicts:
-                return conflicts
-            state = state.apply_action(joint_action)
+        conflicts = self.get_conflicts()
+        if conflicts:
+            return conflicts[0]
         return None
 
     def extract_plan(self):
@@ -53,7 +87,7 @@ class Root:
         return solution
 
 
-def catch_items(state, agent, reachability_maps):
+def catch_items(state, agent, component):
     def get_goal_char(letter, letters):
         if letter in letters:
             if ord('0') <= ord(letter) <= ord('9'):
@@ -63,45 +97,131 @@ def catch_items(state, agent, reachability_maps):
         else:
             return ""
 
-    reachability_map = reachability_maps[agent]
-    agent_color = state.agent_colors[agent]
-    letters = [chr(ord("0") + agent)] + [chr(ord('A') + i) for i in range(26) if state.box_colors[i] == agent_color]
-    boxes = [[state.boxes[row][col] if state.boxes[row][col] in letters and reachability_map[row][col] else "" for col in range(len(state.boxes[0]))] for row in range(len(state.boxes))]
-    goal = [[get_goal_char(state._goals[row][col], letters) if reachability_map[row][col] else "" for col in range(len(state.boxes[0]))] for row in range(len(state.boxes))]
+    def is_reachable(cell):
+        return component[cell] == component[state.agents[agent]]
+
+    agent_color = state.level.agent_colors[agent]
+    letters = [chr(ord("0") + agent)] + [chr(ord('A') + i) for i in range(26) if state.level.box_colors[i] == agent_color]
+    boxes = {cell: letter for cell, letter in zip(state.box_cells, state.box_letters) if letter in letters and is_reachable(cell)}
+    goal = {cell: get_goal_char(letter, letters) for cell, letter in state.level.goals if get_goal_char(letter, letters) and is_reachable(cell)}
     # print(f"boxes: {boxes} goals: {goal} agent: {agent}", file=sys.stderr)
     return boxes, goal
 
 
-def replace_colors(state: State, agent: int) -> State:
-    updated_state = copy.deepcopy(state)
-    agent_color = copy.deepcopy(state.agent_colors[agent])
-    first_box_color = state.box_colors[0]
-    for i in range(len(state.box_colors)):
-        if state.box_colors[i] is not agent_color:
-            updated_state.box_colors[i] = None
-        else:
-            updated_state.box_colors[i] = first_box_color
-    return updated_state
+def single_agent_state(state: State, agent: int, boxes, goal) -> State:
+    """The sub-problem of agent as a single-agent state: the agent becomes agent 0 and keeps only its boxes and goals."""
+    level = state.level.derive(goal, agent_colors=[state.level.agent_colors[agent]])
+    return State(level, [state.agents[agent]], boxes)
+
+
+def sub_problem(state: State, group, boxes, goals):
+    """
+    The sub-problem of the agents of group, planned jointly if there are several: they become agents 0, 1, ... in
+    the order of group and keep the boxes and goals of their single-agent sub-problems (boxes and goals by agent,
+    see catch_items). Returned as the (goals, agent colors, agent cells, boxes) that sub_problem_state turns into a
+    State, which are all a worker process needs besides the level it already has.
+    """
+    group_boxes = {}
+    group_goals = {}
+    for index, agent in enumerate(group):
+        group_boxes.update(boxes[agent])
+        for cell, letter in goals[agent].items():
+            group_goals[cell] = str(index) if letter == "0" else letter
+    agent_colors = tuple(state.level.agent_colors[agent] for agent in group)
+    return group_goals, agent_colors, tuple(state.agents[agent] for agent in group), group_boxes
+
+
+def sub_problem_state(level, goals, agent_colors, agents, boxes) -> State:
+    return State(level.derive(goals, agent_colors=agent_colors), list(agents), boxes)
+
+
+class LowLevelPool:
+    """
+    Runs independent low-level searches, concurrently in worker processes if there are several workers.
+    The workers are forked once per sequential_cbs run with the preprocessed level and its distances, so a search
+    only sends its sub-problem (see sub_problem) and constraints, and receives the plan.
+    Results always come back in the order of the searches, whatever order they finish in, so the high-level search
+    is the same for any number of workers.
+    """
 
+    def __init__(self, level, num_workers=1):
+        self.level = level
+        self.executor = None
+        if num_workers > 1:
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context("fork" if "fork" in methods else None)
+            self.executor = ProcessPoolExecutor(
+                num_workers,
+                mp_context=context,
+                initializer=_init_worker,
+                # The workers start with the memory of this process, which they share copy-on-write but which
+                # counts in the RSS of each; they get an equal share of what is left of the limit on top of it.
+                initargs=(level, HeuristicDijkstra.distances, low_level, State.operator_decomposition,
+                          max(memory.max_usage - memory.get_usage(), 0) / num_workers),
+            )
 
-def cbs_search(initial_state, frontier, reachability_maps):
-    root = Root(len(initial_state.agent_rows))
-    Root.initial_state = copy.deepcopy(initial_state)
+    def plan(self, searches):
+        """
+        The plans of searches, (sub-problem, constraints) pairs as for low_level_search, None where there is none.
+        A single search is run in this process, sparing the round trip to a worker.
+        """
+        if self.executor is None or len(searches) < 2:
+            return [_plan(self.level, problem, constraints) for problem, constraints in searches]
+        return list(self.executor.map(_plan_in_worker, searches))
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+
+# The level of the worker process, set by _init_worker.
+_worker_level = None
+
+
+def _init_worker(level, level_distances, search, operator_decomposition, budget):
+    global _worker_level, low_level
+    _worker_level = level
+    low_level = search
+    HeuristicDijkstra.distances = level_distances
+    HeuristicDijkstra.box_cache = OrderedDict()
+    State.operator_decomposition = operator_decomposition
+    memory.max_usage = memory.get_usage() + budget
+
+
+def _plan_in_worker(search):
+    problem, constraints = search
+    return _plan(_worker_level, problem, constraints)
+
+
+def _plan(level, problem, constraints):
+    return low_level_search(sub_problem_state(level, *problem), constraints=constraints)
+
+
+def cbs_search(initial_state, frontier, component, pool=None):
+    if pool is None:
+        pool = LowLevelPool(initial_state.level)
+    root = Root(len(initial_state.agents))
+    Root.initial_state = initial_state
+    Root.reservations = ReservationTable(initial_state.level, initial_state.agents)
     goals = []
     boxes = []
-    for agent, _ in enumerate(initial_state.agent_rows):
-        state = copy.deepcopy(initial_state)
-        sa_frontier = FrontierBestFirst(HeuristicDijkstra())
-        agent_row, agent_col = [state.agent_rows[agent]], [state.agent_cols[agent]]
-        box, goal = catch_items(state, agent, reachability_maps)
-        sa_state = replace_colors(State(agent_row, agent_col, box, goal, initial_state.box_colors), agent)
+    sa_states = []
+    # MDDs by (agent, constraints, plan length), see choose_conflict.
+    mdds = {}
+    # Conflicts split on so far by pair of agents, see merge_threshold.
+    conflict_counts = {}
+    for agent, _ in enumerate(initial_state.agents):
+        state = initial_state
+        box, goal = catch_items(state, agent, component)
+        sa_state = single_agent_state(state, agent, box, goal)
+        sa_states.append(sa_state)
         # print("Boxes:", agent, sa_state.boxes, file=sys.stderr)
-        # print("Goals:", agent, sa_state._goals, file=sys.stderr)
+        # print("Goals:", agent, sa_state.level.goals, file=sys.stderr)
         goals.append(goal); boxes.append(box)
         # print(f"Initial search for agent {agent} of color {state.agent_colors[agent]} with boxes {state.box_colors}", file=sys.stderr)
-        plan = search(sa_state, sa_frontier)
-        # print(f"Initial plan for agent {agent}: {plan}", file=sys.stderr)
-        root.solution.append(plan)
+    root.solution = tuple(
+        pool.plan([(sub_problem(initial_state, (agent,), boxes, goals), set()) for agent in range(len(sa_states))])
+    )
     frontier.add(root)
     count = 0
     while not frontier.is_empty():
@@ -110,45 +230,112 @@ def cbs_search(initial_state, frontier, reachability_maps):
         for i, solution in enumerate(node.solution):
             print("Popped:", i, solution, file=sys.stderr)
             pass
-        conflict = node.get_conflict()
-        if conflict is None:
+        conflicts = node.get_conflicts()
+        if not conflicts:
             plan = node.extract_plan()
             return plan
+        conflict = choose_conflict(node, conflicts, sa_states, mdds)
+        pair = tuple(sorted(conflict.agents))
+        conflict_counts[pair] = conflict_counts.get(pair, 0) + 1
+        if 0 <= merge_threshold < conflict_counts[pair]:
+            # The pair keeps conflicting: plan their meta-agents jointly instead of splitting again.
+            group = tuple(sorted(set(node.groups[pair[0]]) | set(node.groups[pair[1]])))
+            [plan] = pool.plan([resolution(initial_state, group, node.constraints, boxes, goals)])
+            if plan is not None:
+                print("Merged:", group, file=sys.stderr)
+                frontier.add(node.child(count, split_plan(group, plan), group=group))
+                count += 1
+                continue
+        # The replans of the children are independent, so the pool can run them side by side.
+        children = []
         for agent in conflict.agents:
             constraints = conflict.constraints[agent]
             print("New:", agent, conflict.type, constraints, file=sys.stderr)
-            sa_frontier = FrontierBestFirst(HeuristicDijkstra())
-            m = copy.deepcopy(node)
-            m.count = count
-            m.constraints[agent].update(constraints)
-            print("Total:", agent, m.constraints[agent], file=sys.stderr)
-            if not conflict.resolveable[agent]:
-                plan = None
-            else:
-                plan = resolve_conflict(
-                    agent, m.constraints[agent], initial_state, boxes[agent], goals[agent], state.box_colors
-                )
-                m.solution[agent] = plan
-                if plan:
-                    print("Fixed:", agent, plan, file=sys.stderr)
-                    frontier.add(m)
+            agent_constraints = node.constraints[agent] | constraints
+            print("Total:", agent, agent_constraints, file=sys.stderr)
+            if conflict.resolveable[agent]:
+                children.append((agent, agent_constraints))
+        plans = pool.plan([
+            resolution(
+                initial_state, node.groups[agent], Root._replace(node.constraints, {agent: agent_constraints}),
+                boxes, goals
+            )
+            for agent, agent_constraints in children
+        ])
+        for (agent, agent_constraints), plan in zip(children, plans):
+            group = node.groups[agent]
+            if len(group) > 1:
+                if plan is not None:
+                    print("Fixed:", group, plan, file=sys.stderr)
+                    frontier.add(node.child(count, split_plan(group, plan), {agent: agent_constraints}))
+            elif plan:
+                print("Fixed:", agent, plan, file=sys.stderr)
+                frontier.add(node.child(count, {agent: plan}, {agent: agent_constraints}))
         count += 1
         # print("____________________________________", file=sys.stderr)
 
 
-def resolve_conflict(agent, constraints, initial_state, box, goal, box_colors):
-    sa_frontier = FrontierBestFirst(HeuristicDijkstra())
-    agent_row, agent_col = [initial_state.agent_rows[agent]], [
-        initial_state.agent_cols[agent]
-    ]
-    sa_state = State(agent_row, agent_col, box, goal, box_colors)
-    # print(f"Conflict resolution search for agent {agent}", file=sys.stderr)
-    plan = search(sa_state, sa_frontier, constraints=constraints)
-    return plan
+def choose_conflict(node, conflicts, sa_states, mdds):
+    """
+    The conflict to split node on: the earliest cardinal one, whose constraints raise the cost of both agents' plans,
+    else the earliest semi-cardinal one, raising the cost of one, else the earliest. An agent's constraints raise its
+    cost when they block a whole level of the MDD of its current plan under its current constraints.
+    """
+    level = Root.initial_state.level
+    best, best_cardinality = conflicts[0], 0
+    for conflict in conflicts:
+        cardinality = 0
+        for agent in conflict.agents:
+            key = (agent, node.constraints[agent], len(node.solution[agent]))
+            mdd = mdds.get(key)
+            if mdd is None:
+                mdd = mdds[key] = MDD(sa_states[agent], key[1], key[2], HeuristicDijkstra.distances)
+            if mdd.is_cardinal(conflict.constraints[agent], level):
+                cardinality += 1
+        if cardinality == len(conflict.agents):
+            return conflict
+        if cardinality > best_cardinality:
+            best, best_cardinality = conflict, cardinality
+    return best
+
+
+def low_level_search(sa_state, constraints=set()):
+    """
+    Plans for a single-agent or meta-agent sub-problem under constraints with the search selected by low_level.
+    The constraints of a meta-agent are a tuple of sets, one for each of its agents (see MetaConstraintTable).
+    """
+    if low_level == "idastar":
+        return ida_search(sa_state, HeuristicDijkstra(low_level=True), constraints=constraints)
+    if low_level == "sipp" and len(sa_state.agents) == 1:
+        return sipp_search(sa_state, HeuristicDijkstra(low_level=True), constraints=constraints)
+    return search(sa_state, FrontierBestFirst(HeuristicDijkstra(low_level=True)), constraints=constraints)
+
+
+def resolution(initial_state, group, constraints, boxes, goals):
+    """
+    The search that replans the agents of group, each under its constraints (constraints by agent), as a
+    (sub-problem, constraints) pair for LowLevelPool.plan.
+    """
+    problem = sub_problem(initial_state, group, boxes, goals)
+    if len(group) == 1:
+        return problem, constraints[group[0]]
+    return problem, tuple(constraints[agent] for agent in group)
+
+
+def split_plan(group, joint_plan):
+    """The plans of the agents of group by agent, out of their joint plan and without the NoOps they end with."""
+    plans = {}
+    for index, agent in enumerate(group):
+        plan = [[joint_action[index]] for joint_action in joint_plan]
+        while plan and plan[-1][0] is Action.NoOp:
+            plan.pop()
+        plans[agent] = plan
+    return plans
 
 
 def get_final_state(initial_state, plan):
-    state = copy.deepcopy(initial_state)
+    # States are never modified, apply_action returns a new one.
+    state = initial_state
     for joint_action in plan:
         state = state.apply_action(joint_action)
     return state
@@ -156,39 +343,40 @@ def get_final_state(initial_state, plan):
 
 def sequential_cbs(initial_state):
     state = Preprocessor(initial_state).preprocess()
-    pre_map = Dijkstra(state).distance_matrix()
-    HeuristicDijkstra.pre_processed_map = pre_map
-    floodfill = PathUtils(State.walls)
-    reachability_maps = [floodfill.get_reachability_map((state.agent_rows[agent], state.agent_cols[agent])) for agent in range(len(initial_state.agent_rows))]
-    assigner = Assigner(state)
+    HeuristicDijkstra.distances = distances(state.level)
+    HeuristicDijkstra.box_cache = OrderedDict()
+    pool = LowLevelPool(state.level, workers)
+    try:
+        return _sequential_cbs(initial_state, state, component=components(state.level), pool=pool)
+    finally:
+        pool.shutdown()
+
+
+def _sequential_cbs(initial_state, state, component, pool):
+    assigner = Assigner(state, HeuristicDijkstra.distances)
     agent_tasks = [task[1:-1] for task in assigner.assign_plans()]
     #print(agent_tasks, file=sys.stderr)
-    initial_state_goals = copy.deepcopy(initial_state._goals)
-    boxes = copy.deepcopy(initial_state.boxes)
+    initial_state_goals = initial_state.level.goal_at
     plan = []
     max_task_length = max([len(task) for task in agent_tasks])
     for i in range(max_task_length):
-        goals = [["" for col in range(len(initial_state.boxes[0]))] for row in range(len(initial_state.boxes))]
+        goals = {}
         for j, agent_task in enumerate(agent_tasks):
             try:
                 task = agent_task[i]
-                goals = [[task.letter if task.position == (row, col) else goals[row][col] for col in range(len(initial_state.walls[0]))] for row in range(len(initial_state.walls))]
+                goals[state.level.cell(*task.position)] = task.letter
             except IndexError as e:
                 pass
-        state._goals = goals
+        state = State(state.level.derive(goals), state.agents, dict(zip(state.box_cells, state.box_letters)))
         print(state, file=sys.stderr)
-        step_plan = cbs_search(state, CBSQueue(), reachability_maps)
+        step_plan = cbs_search(state, CBSQueue(), component, pool)
         print(step_plan, file=sys.stderr)
         plan += step_plan
         # print(plan, file=sys.stderr)
         state = get_final_state(state, step_plan)
         print(state, file=sys.stderr)
-        boxes = state.boxes
-        for row in range(len(boxes)):
-            for col in range(len(boxes[0])):
-                if boxes[row][col] == initial_state_goals[row][col]:
-                    boxes[row][col] = ""
-        state.boxes = boxes
+        boxes = {cell: letter for cell, letter in zip(state.box_cells, state.box_letters) if initial_state_goals.get(cell) != letter}
+        state = State(state.level, state.agents, boxes)
         # print(boxes, file=sys.stderr)
     # print(plan, file=sys.stderr)
     # print(get_final_state(initial_state, plan), file=sys.stderr)
@@ -1,4 +1,5 @@
 import sys
+from math import inf
 
 
 class Conflict:
@@ -67,3 +68,220 @@ class Conflict:
                     if self.type == "FOLLOW":
                         resolveable[agent] = False  # Not resolveable for t < 0
         return resolveable
+
+
+class ConstraintTable:
+    """
+    Constraints of one low-level search compiled for fast lookups.
+    A constraint (v, t) forbids the agent to end the action it starts at time t in cell v, see State.is_applicable.
+    The table keeps a set of (cell, time) keys for applicability checks and a sorted list of constrained times per cell.
+    max_time is the latest constrained time, after which nothing is blocked any more.
+    """
+
+    def __init__(self, constraints, level: "Level"):
+        self.num_cells = level.num_cells
+        self.keys = set()
+        self.times = {}
+        self.max_time = -1
+        # cell -> safe intervals, computed on demand by safe_intervals.
+        self.intervals = {}
+        for (row, col), time in constraints:
+            cell = level.cell(row, col)
+            self.keys.add(time * self.num_cells + cell)
+            self.times.setdefault(cell, []).append(time)
+            self.max_time = max(self.max_time, time)
+        for times in self.times.values():
+            times.sort()
+
+    @classmethod
+    def compile(cls, constraints, level: "Level") -> "ConstraintTable":
+        """
+        Compiles a set of constraints, which bind every agent alike, or a tuple or list of sets, one for each agent
+        of a meta-agent (see MetaConstraintTable).
+        """
+        if isinstance(constraints, (ConstraintTable, MetaConstraintTable)):
+            return constraints
+        if isinstance(constraints, (tuple, list)):
+            return MetaConstraintTable([cls(agent_constraints, level) for agent_constraints in constraints])
+        return cls(constraints, level)
+
+    def forbids(self, cell: "int", time: "int", agent: "int" = 0) -> "bool":
+        """True if an action started at time may not end in cell."""
+        return time * self.num_cells + cell in self.keys
+
+    def blocked_after(self, cell: "int", time: "int", agent: "int" = 0) -> "bool":
+        """True if an agent can not stay in cell from time on, i.e. cell is constrained at time or later."""
+        times = self.times.get(cell)
+        return times is not None and times[-1] >= time
+
+    def safe_intervals(self, cell: "int") -> "[(int, float), ...]":
+        """
+        The maximal (first, last) ranges of time steps during which the agent may be in cell, in order, the last
+        ending at infinity. A constraint (cell, t) makes time t + 1 unsafe; like forbids, constraints before time 0
+        restrict nothing since the agent only starts to act at time 0.
+        """
+        intervals = self.intervals.get(cell)
+        if intervals is None:
+            intervals = []
+            first = 0
+            for time in self.times.get(cell, ()):
+                if time < 0:
+                    continue
+                unsafe = time + 1
+                if unsafe > first:
+                    intervals.append((first, unsafe - 1))
+                first = max(first, unsafe + 1)
+            intervals.append((first, inf))
+            self.intervals[cell] = intervals
+        return intervals
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class MetaConstraintTable:
+    """The constraints of the agents of a meta-agent, one ConstraintTable each, looked up by agent."""
+
+    def __init__(self, tables: "[ConstraintTable, ...]"):
+        self.tables = tables
+        self.max_time = max((table.max_time for table in tables), default=-1)
+
+    def forbids(self, cell: "int", time: "int", agent: "int" = 0) -> "bool":
+        return self.tables[agent].forbids(cell, time)
+
+    def blocked_after(self, cell: "int", time: "int", agent: "int" = 0) -> "bool":
+        return self.tables[agent].blocked_after(cell, time)
+
+    def __len__(self):
+        return sum(len(table) for table in self.tables)
+
+
+class ReservationTable:
+    """
+    Space-time reservations of the agents' plans in one CBS run: the agent occupying each cell at each time step,
+    and the cell and time at which every agent parks once its plan has ended.
+    Moving between CBS nodes only updates the reservations of the plans that differ, from the first step at which
+    they differ (see update), and conflicts finds every conflict between the plans in one pass over them.
+    """
+
+    # Order in which conflicts between the same two agents at the same time are reported: vertex, edge, the first
+    # agent following the second, the second following the first.
+    VERTEX, EDGE, FOLLOW, FOLLOWED = range(4)
+
+    def __init__(self, level: "Level", starts: "[int, ...]"):
+        self.level = level
+        self.num_cells = level.num_cells
+        # (time * num_cells + cell) -> agents occupying cell at time while their plan runs.
+        self.vertices = {}
+        # cell -> [(agent, time), ...] of the agents standing in cell from time on, once their plan has ended.
+        self.parked = {}
+        self.plans = [None for _ in starts]
+        self.paths = [[start] for start in starts]
+        for agent, start in enumerate(starts):
+            self._reserve(agent, 0)
+
+    def update(self, solution: "[[[Action], ...], ...]"):
+        """Makes the reservations those of solution, the plan of every agent as in Root.solution."""
+        for agent, plan in enumerate(solution):
+            if plan is not self.plans[agent]:
+                self.set_plan(agent, plan)
+
+    def set_plan(self, agent: "int", plan: "[[Action], ...]"):
+        """Replaces the reservations of agent from the first step at which plan leaves its current path."""
+        transitions = self.level.transitions
+        old_path = self.paths[agent]
+        path = [old_path[0]]
+        for joint_action in plan:
+            path.append(transitions[joint_action[0]][path[-1]][0])
+        self.plans[agent] = plan
+        if path == old_path:
+            return
+        first = 0
+        for old_cell, cell in zip(old_path, path):
+            if old_cell != cell:
+                break
+            first += 1
+        # Both paths keep their reservations up to first, except for their last cells where the agent parks.
+        start = min(first, len(old_path) - 1, len(path) - 1)
+        self._release(agent, start)
+        self.paths[agent] = path
+        self._reserve(agent, start)
+
+    def _reserve(self, agent: "int", start: "int"):
+        num_cells = self.num_cells
+        vertices = self.vertices
+        path = self.paths[agent]
+        for time in range(start, len(path)):
+            vertices.setdefault(time * num_cells + path[time], []).append(agent)
+        self.parked.setdefault(path[-1], []).append((agent, len(path) - 1))
+
+    def _release(self, agent: "int", start: "int"):
+        """Drops the reservations of agent from its step start on."""
+        num_cells = self.num_cells
+        vertices = self.vertices
+        path = self.paths[agent]
+        for time in range(start, len(path)):
+            key = time * num_cells + path[time]
+            agents = vertices[key]
+            agents.remove(agent)
+            if not agents:
+                del vertices[key]
+        parked = self.parked[path[-1]]
+        parked.remove((agent, len(path) - 1))
+        if not parked:
+            del self.parked[path[-1]]
+
+    def occupants(self, cell: "int", time: "int") -> "[int, ...]":
+        """The agents in cell at time."""
+        agents = list(self.vertices.get(time * self.num_cells + cell, ()))
+        for agent, end in self.parked.get(cell, ()):
+            if end < time:
+                agents.append(agent)
+        return agents
+
+    def position(self, agent: "int", time: "int") -> "int":
+        path = self.paths[agent]
+        return path[time] if time < len(path) else path[-1]
+
+    def conflicts(self) -> "[Conflict, ...]":
+        """
+        Every conflict between the plans, at most one per pair of agents and time step, ordered by time and agents.
+        An agent only conflicts while it moves, so each step of each path is looked up against the table once.
+        """
+        positions = self.level.positions
+        found = {}
+
+        def report(time, a1, a2, rank):
+            key = (time, a1, a2)
+            if key not in found or rank < found[key]:
+                found[key] = rank
+
+        for agent, path in enumerate(self.paths):
+            for time in range(len(path) - 1):
+                destination = path[time + 1]
+                for other in self.occupants(destination, time + 1):
+                    if other != agent:
+                        report(time, min(agent, other), max(agent, other), self.VERTEX)
+                for other in self.occupants(destination, time):
+                    if other == agent:
+                        continue
+                    if self.position(other, time + 1) == path[time]:
+                        report(time, min(agent, other), max(agent, other), self.EDGE)
+                    elif agent < other:
+                        report(time, agent, other, self.FOLLOW)
+                    else:
+                        report(time, other, agent, self.FOLLOWED)
+
+        conflicts = []
+        for (time, a1, a2), rank in sorted(found.items()):
+            if rank == self.VERTEX:
+                conflicts.append(Conflict.vertex((a1, a2, positions[self.position(a1, time + 1)], time)))
+            elif rank == self.EDGE:
+                v1 = positions[self.position(a1, time)]
+                v2 = positions[self.position(a1, time + 1)]
+                conflicts.append(Conflict.edge((a1, a2, v1, v2, time)))
+            elif rank == self.FOLLOW:
+                conflicts.append(Conflict.follow((a1, a2, positions[self.position(a1, time + 1)], time)))
+            else:
+                conflicts.append(Conflict.follow((a2, a1, positions[self.position(a2, time + 1)], time)))
+        return conflicts
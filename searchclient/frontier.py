@@ -1,7 +1,7 @@
 from abc import ABCMeta, abstractmethod
 from collections import deque
-from queue import PriorityQueue
 from itertools import count
+import heapq
 
 
 class Frontier(metaclass=ABCMeta):
@@ -13,6 +13,11 @@ class Frontier(metaclass=ABCMeta):
     def pop(self) -> "State":
         raise NotImplementedError
 
+    def add_batch(self, states: "[State, ...]"):
+        """Adds all the (new) children of an expansion."""
+        for state in states:
+            self.add(state)
+
     @abstractmethod
     def is_empty(self) -> "bool":
         raise NotImplementedError
@@ -58,54 +63,95 @@ class FrontierBFS(Frontier):
         return "breadth-first search"
 
 
-class FrontierDFS(Frontier):
-    def __init__(self):
-        super().__init__()
-        raise NotImplementedError
-
-    def add(self, state: "State"):
-        raise NotImplementedError
-
-    def pop(self) -> "State":
-        raise NotImplementedError
-
-    def is_empty(self) -> "bool":
-        raise NotImplementedError
-
-    def size(self) -> "int":
-        raise NotImplementedError
-
-    def contains(self, state: "State") -> "bool":
-        raise NotImplementedError
-
-    def get_name(self):
-        return "depth-first search"
+def _depth(state: "State") -> "float":
+    """
+    The g of state, less the share of the agents yet to choose their action if it is an intermediate node of
+    operator decomposition, which already has the g of the step it is in.
+    """
+    if state.pending is None:
+        return state.g
+    return state.g - (len(state.agents) - len(state.pending)) / len(state.agents)
 
 
 class FrontierBestFirst(Frontier):
-    def __init__(self, heuristic: "Heuristic"):
+    # Secondary keys for states with equal f, smallest first.
+    TIE_BREAKING = {
+        "high-g": lambda state: -_depth(state),  # deepest first, i.e. lowest h for A*
+        "low-g": lambda state: state.g,
+        "fifo": lambda state: 0,
+    }
+
+    def __init__(self, heuristic: "Heuristic", tie_breaking: "str" = "high-g"):
         super().__init__()
         self.heuristic = heuristic
-        self.queue = PriorityQueue()
-        self.set = set()
+        self._f = heuristic.f
+        self._f_batch = heuristic.f_batch
+        self._tie = FrontierBestFirst.TIE_BREAKING[tie_breaking]
+        # Heap of [f, tie, count, state] entries. An entry whose state is None was replaced by a better one.
+        self.heap = []
+        # The live heap entry of every state in the frontier.
+        self.entries = {}
         self._counter = count()
 
     def add(self, state: "State"):
-        f = self.heuristic.f(state)
-        self.queue.put((f, next(self._counter), state))
-        self.set.add(state)
+        self._push(state, self._f(state))
+
+    def add_batch(self, states: "[State, ...]"):
+        # The heuristic evaluates all children in one pass, see Heuristic.h_batch.
+        for state, f in zip(states, self._f_batch(states)):
+            self._push(state, f)
+
+    def _push(self, state: "State", f):
+        entry = [f, self._tie(state), next(self._counter), state]
+        old_entry = self.entries.get(state)
+        if old_entry is not None:
+            # Decrease-key: keep the cheaper path to the state, the other entry is skipped when popped.
+            if old_entry[3].g <= state.g:
+                return
+            old_entry[3] = None
+        self.entries[state] = entry
+        heapq.heappush(self.heap, entry)
 
     def pop(self) -> "State":
-        return self.queue.get()[2]
+        while True:
+            state = heapq.heappop(self.heap)[3]
+            if state is not None:
+                del self.entries[state]
+                return state
 
     def is_empty(self) -> "bool":
-        return self.queue.empty()
+        return len(self.entries) == 0
+
+    def greedy(self) -> "bool":
+        """
+        Orders the frontier by h alone from now on, giving up optimality to reach a goal with fewer expansions.
+        Returns False if it already was.
+        """
+        if self._f == self.heuristic.h:
+            return False
+        self._f = self.heuristic.h
+        self._f_batch = self.heuristic.h_batch
+        self.heap = list(self.entries.values())
+        for entry in self.heap:
+            entry[0] = self._f(entry[3])
+        heapq.heapify(self.heap)
+        return True
+
+    def prune(self, fraction: "float" = 0.5) -> "[State, ...]":
+        """Drops all but the best fraction of the frontier and returns the dropped states."""
+        live = sorted(self.entries.values())
+        keep = max(1, int(len(live) * fraction))
+        self.heap = live[:keep]  # A sorted list is a heap.
+        dropped = [entry[3] for entry in live[keep:]]
+        for state in dropped:
+            del self.entries[state]
+        return dropped
 
     def size(self) -> "int":
-        return self.queue.qsize()
+        return len(self.entries)
 
     def contains(self, state: "State") -> "bool":
-        return state in self.set
+        return state in self.entries
 
     def get_name(self):
         return "best-first search using {}".format(self.heuristic)
@@ -113,7 +159,7 @@ class FrontierBestFirst(Frontier):
 
 class CBSQueue:
     def __init__(self):
-        self.queue = PriorityQueue()
+        self.heap = []
         self.set = set()
         self._counter = count()
 
@@ -130,17 +176,19 @@ class CBSQueue:
         cost = self._cost(node)
         node.cost = cost
         if cost < float("inf"):
-            self.queue.put((cost, next(self._counter), node))
+            heapq.heappush(self.heap, (cost, next(self._counter), node))
             self.set.add(node)
 
     def pop(self) -> "State":
-        return self.queue.get()[2]
+        node = heapq.heappop(self.heap)[2]
+        self.set.remove(node)
+        return node
 
     def is_empty(self) -> "bool":
-        return self.queue.empty()
+        return len(self.heap) == 0
 
     def size(self) -> "int":
-        return self.queue.qsize()
+        return len(self.heap)
 
     def contains(self, state: "State") -> "bool":
         return state in self.set
@@ -1,8 +1,14 @@
 import memory
 import time
 import sys
+from collections import OrderedDict
+from itertools import count
+from math import inf
+import heapq
 
 from action import Action
+from conflict import ConstraintTable
+from frontier import FrontierBestFirst
 from assigner import Assigner
 from preprocessing import Preprocessor
 globals().update(Action.__members__)
@@ -10,21 +16,28 @@ globals().update(Action.__members__)
 start_time = time.perf_counter()
 
 def search(initial_state, frontier, constraints=set()):
+    constraints = ConstraintTable.compile(constraints, initial_state.level)
     iterations = 0
 
+    # Every state generated so far, open or closed -> best g found, so each child costs one lookup.
+    nodes = {initial_state: initial_state.g}
     frontier.add(initial_state)
-    explored = set()
+    governor = memory.MemoryGovernor()
 
     while True:
         iterations += 1
         if iterations % 1000 == 0:
             pass
-            # print_search_status(explored, frontier)
+            # print_search_status(nodes, frontier)
 
-        if memory.get_usage() > memory.max_usage:
-            # print_search_status(explored, frontier)
+        status = governor.check(len(nodes))
+        if status == memory.HARD:
+            # print_search_status(nodes, frontier)
             # print("Maximum memory usage exceeded.", file=sys.stderr, flush=True)
             return None
+        if status == memory.SOFT:
+            # A search that cannot shed anything keeps going until the hard limit.
+            relieve_memory(frontier, nodes)
 
         if frontier.is_empty():
             return None
@@ -40,21 +53,183 @@ def search(initial_state, frontier, constraints=set()):
             # print(f"{plan}\n{constraints}\n{state.t}\n\n", file=sys.stderr, flush=True)
             return plan
 
-        explored.add(state)
-
+        children = []
         for child in state.get_expanded_states(constraints):
-            if not frontier.contains(child) and child not in explored:
-                frontier.add(child)
+            known = nodes.get(child)
+            if known is not None and known <= child.g:
+                # Open or closed, the state was already reached at least as cheaply.
+                continue
+            # New, a cheaper path to an open state (decrease-key in the frontier),
+            # or a cheaper path to a closed one, which is reopened as an inconsistent heuristic may need.
+            nodes[child] = child.g
+            children.append(child)
+        frontier.add_batch(children)
+
+
+# Default number of states in the transposition table of ida_search.
+IDA_TABLE_SIZE = 1 << 20
+
+def ida_search(initial_state, heuristic, constraints=set(), table_size=IDA_TABLE_SIZE):
+    """
+    Iterative-deepening A*: depth-first searches bounded by f = g + h, the bound raised to the smallest f that
+    exceeded it until a goal is found. Only the current path and its siblings are held, plus a transposition table
+    of at most table_size states with the cost-to-go learned for them (LRU eviction), so memory does not grow
+    with the depth or the length of the search.
+    Above the soft memory limit the table gives up its least recently used half, above the hard limit the search
+    gives up.
+    """
+    constraints = ConstraintTable.compile(constraints, initial_state.level)
+    # Key of a state -> lower bound on its cost-to-go learned by exhausting it under an earlier (or the current)
+    # bound. A state exhausted under the current bound has g + bound > bound, so transpositions are skipped as well.
+    # The keys compare like states but, unlike them, do not hold on to their parents.
+    table = OrderedDict()
+    governor = memory.MemoryGovernor()
+
+    def key(state):
+        return state.agents, state.box_cells, state.box_letters, state.t, state.pending
+
+    def h(state):
+        learned = table.get(key(state))
+        if learned is None:
+            return heuristic.h(state)
+        table.move_to_end(key(state))
+        return learned
+
+    def learn(state, cost_to_go):
+        table[key(state)] = cost_to_go
+        table.move_to_end(key(state))
+        if len(table) > table_size:
+            table.popitem(last=False)
+
+    def out_of_memory(depth):
+        status = governor.check(len(table) + depth)
+        if status == memory.SOFT:
+            for _ in range(len(table) // 2):
+                table.popitem(last=False)
+        return status == memory.HARD
+
+    if initial_state.is_goal_state(constraints):
+        return initial_state.extract_plan()
+    bound = initial_state.g + h(initial_state)
+    while bound < inf:
+        if out_of_memory(0):
+            return None
+        # Frames of [state, iterator over its children, smallest f below it that exceeded the bound].
+        stack = [[initial_state, iter(initial_state.get_expanded_states(constraints)), inf]]
+        while stack:
+            if out_of_memory(len(stack)):
+                return None
+            frame = stack[-1]
+            child = next(frame[1], None)
+            if child is None:
+                stack.pop()
+                state, _, exceeded = frame
+                learn(state, exceeded - state.g)
+                if stack:
+                    stack[-1][2] = min(stack[-1][2], exceeded)
+                continue
+            f = child.g + h(child)
+            if f > bound:
+                if f < frame[2]:
+                    frame[2] = f
+                continue
+            if child.is_goal_state(constraints):
+                return child.extract_plan()
+            stack.append([child, iter(child.get_expanded_states(constraints)), inf])
+        bound = exceeded
+    return None
+
+
+def sipp_search(initial_state, heuristic, constraints=set()):
+    """
+    Safe interval path planning for a single agent: A* over (agent cell, boxes, safe interval of the agent cell)
+    with the earliest arrival time in the interval as g, instead of over time steps. Waiting is implicit, an action
+    can start at any time the agent can still stay in its interval, so a node has as many successors per action as
+    there are safe intervals of the destination it can reach, and the search grows with the number of constraints
+    rather than with the time they force the agent to wait. Boxes are not constrained and no other agent moves in
+    a sub-problem, so the boxes do not change while the agent waits.
+    Returns the plan with the waits as NoOps, like search.
+    """
+    constraints = ConstraintTable.compile(constraints, initial_state.level)
+    cell = initial_state.agents[0]
+    intervals = constraints.safe_intervals(cell)
+    start = (cell, initial_state.box_cells, 0)
+    # Node -> (earliest arrival, state, end of its interval, parent node, action from the parent).
+    nodes = {start: (0, initial_state, intervals[0][1], None, None)}
+    tie = count()
+    # (f, -g, insertion order, node): ties on f go to the node with the highest g, as in FrontierBestFirst.
+    open_list = [(heuristic.h(initial_state), 0, next(tie), start)]
+    governor = memory.MemoryGovernor()
+
+    while open_list:
+        if governor.check(len(nodes)) == memory.HARD:
+            return None
+        _, arrival, _, node = heapq.heappop(open_list)
+        arrival = -arrival
+        known, state, end, _, _ = nodes[node]
+        if arrival > known:
+            continue
+        if state.unsatisfied == 0 and end == inf:
+            return _sipp_plan(nodes, node)
+
+        for child in state.get_expanded_states(None):
+            action = child.joint_action[0]
+            if action is NoOp:
+                continue
+            destination = child.agents[0]
+            for index, (first, last) in enumerate(constraints.safe_intervals(destination)):
+                if last < arrival + 1:
+                    continue
+                # Wait in the current interval, then arrive as early as the destination interval allows.
+                child_arrival = max(arrival + 1, first)
+                if child_arrival - 1 > end:
+                    break
+                key = (destination, child.box_cells, index)
+                known = nodes.get(key)
+                if known is not None and known[0] <= child_arrival:
+                    continue
+                nodes[key] = (child_arrival, child, last, node, action)
+                heapq.heappush(open_list, (child_arrival + heuristic.h(child), -child_arrival, next(tie), key))
+    return None
+
+
+def _sipp_plan(nodes, node):
+    plan = []
+    while True:
+        arrival, _, _, parent, action = nodes[node]
+        if parent is None:
+            break
+        plan.append([action])
+        plan.extend([NoOp] for _ in range(arrival - nodes[parent][0] - 1))
+        node = parent
+    plan.reverse()
+    return plan
+
+
+def relieve_memory(frontier, nodes) -> 'bool':
+    """
+    Graceful degradation above the soft memory limit: first turn a best-first search greedy, then keep halving
+    its frontier. The dropped states leave the node table too, so they can be generated again.
+    Returns False if the frontier cannot shed anything.
+    """
+    if not isinstance(frontier, FrontierBestFirst) or frontier.size() < 2:
+        return False
+    if frontier.greedy():
+        print("Memory usage above soft limit, switching to greedy search.", file=sys.stderr, flush=True)
+        return True
+    for state in frontier.prune(0.5):
+        del nodes[state]
+    return True
 
 
-def print_search_status(explored, frontier):
+def print_search_status(nodes, frontier):
     status_template = "#Expanded: {:8,}, #Frontier: {:8,}, #Generated: {:8,}, Time: {:3.3f} s\n[Alloc: {:4.2f} MB, MaxAlloc: {:4.2f} MB]"
     elapsed_time = time.perf_counter() - start_time
     print(
         status_template.format(
-            len(explored),
+            len(nodes) - frontier.size(),
             frontier.size(),
-            len(explored) + frontier.size(),
+            len(nodes),
             elapsed_time,
             memory.get_usage(),
             memory.max_usage,
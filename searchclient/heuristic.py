@@ -3,8 +3,12 @@ import sys
 import math
 import heapq
 
+from matching import min_cost_assignment
+
 class Heuristic(metaclass=ABCMeta):
-    def __init__(self, initial_state: 'State'):
+    def __init__(self, initial_state: 'State', estimate=None):
+        # Evaluation h delegates to, such as a HeuristicDijkstra; None for the goal count.
+        self.estimate = estimate
         # Here's a chance to pre-process the static parts of the level.
         #self.x_goal
         #self.y_goal
@@ -50,191 +54,350 @@ class Heuristic(metaclass=ABCMeta):
         #             box_to_goal_h+=self.map[goal_pos][agent_pos]
         # # print(agent_to_box_h+box_to_goal_h,file=sys.stderr)
         # return agent_to_box_h+box_to_goal_h
-        return 0
+
+        if self.estimate is not None:
+            return self.estimate.h(state)
+        # Goal count: the number of unsatisfied goals, which every state keeps up to date.
+        return state.unsatisfied
 
     @abstractmethod
     def f(self, state: 'State') -> 'int':
         pass
 
+    def h_batch(self, states) -> 'list':
+        '''h of all the children of an expansion at once, see FrontierBestFirst.add_batch.'''
+        if self.estimate is not None:
+            return self.estimate.h_batch(states)
+        return [self.h(state) for state in states]
+
+    def f_batch(self, states) -> 'list':
+        return [self.f(state) for state in states]
+
     @abstractmethod
     def __repr__(self):
         raise NotImplementedError
 
 
 class HeuristicDijkstra:
-    assigned_boxes = []
-    assigned_goals = []
-    pre_processed_map = None
-    def __init__(self):
-        pass
-    
-    def h(self, state) -> 'int':
+    # DistanceTable of the level, set before the searches that use this heuristic.
+    distances = None
+    # Box-dependent parts of h by (goal cells, box cells) of a letter, shared by the searches of one CBS run
+    # (see sequential_cbs) since replans evaluate the same box configurations over and over. None to disable.
+    box_cache = None
+    BOX_CACHE_SIZE = 1 << 16
+    # How the costs of the agents of a joint state combine, see matching.
+    COMBINE = ('sum', 'max')
+    def __init__(self, combine: 'str' = 'sum', low_level: 'bool' = False):
+        # The goals of the level last compiled by compile_goals, see there.
+        self.level = None
+        self.combine = combine
+        # CBS low-level searches of a single agent towards a single goal letter take the cheaper, inadmissible
+        # single_goal + agent_to_box estimate instead of the matching.
+        self.low_level = low_level
 
-        agent_row = state.agent_rows
-        # print(agent_row,file=sys.stderr)
-        agent_col = state.agent_cols
-        agent_to_box_h = 0
-        box_to_goal_h = 0
-        find_agent = None
-        find_boxes = {}
-        # print("goals",state._goals,file=sys.stderr)
-        # print("GOALS HERE GET YOUR GOALS HERE",state._goals,file=sys.stderr)
-        #if multiple boxes with one goal
-        goal_amount = 0
+    def compile_goals(self, level):
+        '''
+        Indexes the goals of level once per search instead of once per state: the first goal cell of every goal
+        character, and the distance field (distances to every cell) of each goal the heuristic measures from.
+        '''
+        self.level = level
         find_goals = {}
-        single_goal = None
-        for row, rows in enumerate(state._goals):
-            for col, cols in enumerate(rows):
-                if cols != '':
-                    if cols not in find_goals:
-                        find_goals[cols] = (col,row)
-                        single_goal = cols
-                        goal_pos = (col,row)
-                        goal_amount+=1
-        # print(goal_amount,file=sys.stderr)
-        if goal_amount == 1:
-            return self.single_goal(state,find_goals,single_goal)
-        elif goal_amount > 1:
-            # print("goal_amount",goal_amount,file=sys.stderr)
-            # return self.mult_goals(state,find_goals)
-            pass
-        hej = "CHECK IF MULTIPLE GOALS FUCKS THE DICT"
-              
-
-        #If multiple boxes and multiple goals
-        #agent to boxes h if only checking one agent at a time
-        if len(agent_row) == 1:
-            for row_pos, row in enumerate(state.boxes):
-                # print("this is before 2nd loop", find_boxes,file=sys.stderr)
-                for col_pos, col in enumerate(row):
-                    if col != '':
-                        find_boxes[col] = (col_pos, row_pos)
-                        box_pos = (col_pos, row_pos)
-                        agent_pos = (agent_col[0],agent_row[0])
-                        if box_pos in self.pre_processed_map[agent_pos]:
-                            agent_to_box_h+=self.pre_processed_map[agent_pos][box_pos]
-                        else:
-                            continue
-
-            
-        elif len(agent_row) > 1:
-            for agent, agent_dic in enumerate(self.assigned_boxes):
-                for letter in agent_dic[0]:
-                    if len(agent_dic[0][letter]) > 0:
-                        find_boxes[col] = (col_pos, row_pos)
-                        box_pos = (agent_dic[0][letter][0][1],agent_dic[0][letter][0][0])
-                        agent_pos = (col[agent],row[agent])
-                        agent_to_box_h+=self.pre_processed_map[agent_pos][box_pos]
-        #box to goal len == 1
-        last_box = None           
-        for row, rows in enumerate(state._goals):
-            for col, cols in enumerate(rows):
-                if cols != '' and "A" <= cols <= "Z":
-                    box_pos = find_boxes[cols]
-                    last_box = find_boxes[cols]
-                    goal_pos = (col,row)
-                    if box_pos in self.pre_processed_map[goal_pos]:
-                        box_to_goal_h+=self.pre_processed_map[goal_pos][box_pos]
-                    else:
-                        continue
-                    
-                    
-        #agent to goal len == 1
-        for row, rows in enumerate(state._goals):
-            for col, cols in enumerate(rows):
-                if cols != '' and "0" <= cols <= "9":
-                    if len(find_boxes) > 0:
-                        goal_pos = (col,row)
-                        agent_pos = find_boxes[list(find_boxes.keys())[-1]]
-                        box_to_goal_h+=self.pre_processed_map[goal_pos][box_pos]
-                    else:
-                        goal_pos = (col,row)
-                        agent_pos = last_box
-                        box_to_goal_h+=self.pre_processed_map[goal_pos][agent_pos]
-        return box_to_goal_h+agent_to_box_h
-    
+        for cell, cols in level.goals:
+            if cols != '' and cols not in find_goals:
+                find_goals[cols] = cell
+        self.find_goals = find_goals
+        # The goal character if there is only one, which is the common case of a CBS sub-problem.
+        self.single_goal_letter = next(iter(find_goals)) if len(find_goals) == 1 else None
+        if self.single_goal_letter is not None:
+            self.single_goal_field = self.distances.field(find_goals[self.single_goal_letter])
+        self.box_goal_fields = {
+            letter: [self.distances.field(cell) for cell in cells]
+            for letter, cells in level.goals_by_letter.items()
+            if "A" <= letter <= "Z"
+        }
+        self.agent_goal_fields = {
+            int(letter): self.distances.field(cells[0])
+            for letter, cells in level.goals_by_letter.items()
+            if "0" <= letter <= "9"
+        }
+        # Cost of a box that cannot reach a goal in the matchings, more than any real distance.
+        self.unreachable = level.num_cells
+        self.color_agents = {}
+        for color in level.agent_colors:
+            if color is not None:
+                self.color_agents[color] = self.color_agents.get(color, 0) + 1
+
+    def h(self, state) -> 'int':
+        if state.level is not self.level:
+            self.compile_goals(state.level)
+        if self.low_level and self.single_goal_letter is not None and len(state.agents) == 1:
+            return self.single_goal(state) + self.agent_to_box(state)
+        return self.matching(state)
 
     def f(self, state: 'State') -> 'int':
         return state.g+self.h(state)
 
     def __repr__(self):
-        pass
+        if self.combine == 'max':
+            return 'box-goal matching makespan evaluation'
+        return 'box-goal matching evaluation'
 
-    def mult_goals(self, state, goals):
-        agent_row = state.agent_rows
-        # print(agent_row,file=sys.stderr)
-        agent_col = state.agent_cols
-        agent_to_box_h = 0
-        box_to_goal_h = 0
-        find_agent = None
-        find_boxes = {}
-        #If multiple boxes and multiple goals
-        #agent to boxes h if only checking one agent at a time
-        for row_pos, row in enumerate(state.boxes):
-            # print("this is before 2nd loop", find_boxes,file=sys.stderr)
-            for col_pos, col in enumerate(row):
-                if col in goals:
-                    goal_pos = goals[col]
-                    box_pos = (col_pos, row_pos)
-                    agent_pos = (agent_col[0],agent_row[0])
-                    if box_pos in self.pre_processed_map[agent_pos]:
-                        agent_to_box_h+=self.pre_processed_map[agent_pos][box_pos]
-                    if box_pos in self.pre_processed_map[goal_pos]:
-                        box_to_goal_h+=self.pre_processed_map[box_pos][goal_pos]
-                    else:
-                        continue
-        return agent_to_box_h+box_to_goal_h
-    
-    def single_goal(self,state,goal,goal_letter):
-        agent_row = state.agent_rows[0]
-        agent_col = state.agent_cols[0]
+    def matching(self, state):
+        '''
+        For every letter, the least total distance of its boxes to its goals over all ways to match them one-to-one
+        (min_cost_assignment), and for every agent the distance to its goal or, while boxes of its color are off
+        their goals, to the nearest such box.
+        With combine 'sum' these all add up, an estimate of the sum of costs. With 'max' it is the makespan of the
+        slowest color, whose agents reach their nearest box and then share the moves of its boxes evenly, the time
+        until a box can be on its goal for the goal farthest from one (see delivery), or the distance of the agent
+        farthest from its goal if that is more.
+        The matching cost of each letter is kept in state.h_cache, and a child only solves the letters of the boxes
+        its action moved.
+        The g of an intermediate node of operator decomposition already counts its step (see State._intermediate),
+        so the agents yet to choose an action take one off the terms they can still shorten in it.
+        '''
+        costs = self.letter_costs(state)
+        level = state.level
+        approach = self.approach(state, costs)
+        decided = len(state.agents) if state.pending is None else len(state.pending)
+        if self.combine == 'max':
+            work = {}
+            for letter, cost in costs.items():
+                color = level.box_colors[ord(letter) - ord('A')]
+                work[color] = work.get(color, 0) + cost
+            first = {}
+            for agent, d in enumerate(approach):
+                if d is not None:
+                    color = level.agent_colors[agent]
+                    first[color] = d if color not in first else min(first[color], d)
+            undecided = {level.agent_colors[agent] for agent in range(decided, len(state.agents))}
+            h = 0
+            for color, cost in work.items():
+                if cost > 0:
+                    agents = self.color_agents.get(color, 1)
+                    h = max(h, first.get(color, 0) + (cost + agents - 1) // agents - (color in undecided))
+            for color, steps in self.delivery(state, costs).items():
+                h = max(h, steps - (color in undecided))
+            for agent, agent_pos in enumerate(state.agents):
+                if agent in self.agent_goal_fields:
+                    h = max(h, self.agent_goal_fields[agent][agent_pos] - (agent >= decided))
+            return h
+        agent_h = 0
+        for agent, agent_pos in enumerate(state.agents):
+            if approach[agent] is not None:
+                agent_h += approach[agent]
+            elif agent in self.agent_goal_fields:
+                agent_h += max(self.agent_goal_fields[agent][agent_pos], 0)
+        return max(sum(costs.values()) + agent_h - (len(state.agents) - decided), 0)
+
+    def letter_costs(self, state):
+        '''The matching cost of every letter with goals, by letter, from the parent's where boxes did not move.'''
+        level = state.level
+        parent = state.parent
+        costs = None
+        if parent is not None and parent.h_cache is not None and state.joint_action is not None:
+            costs = parent.h_cache
+            if state.box_cells is not parent.box_cells:
+                # A box moved: solve its letter again.
+                costs = dict(costs)
+                for agent, action in enumerate(state.joint_action):
+                    _, box_from, box_to = level.transitions[action][parent.agents[agent]]
+                    if box_from >= 0:
+                        letter = state.box_at(box_to)
+                        if letter in costs:
+                            costs[letter] = self.match_letter(state, letter)
+        if costs is None:
+            costs = {letter: self.match_letter(state, letter) for letter in self.box_goal_fields}
+        state.h_cache = costs
+        return costs
+
+    def approach(self, state, costs):
+        '''
+        For every agent, the distance to the nearest box of its color off the goals of its letter, less the last
+        step since the agent only needs to get next to it; None if there is no such box.
+        '''
+        level = state.level
+        distance = self.distances.distance
+        approach = []
+        for agent, agent_pos in enumerate(state.agents):
+            color = level.agent_colors[agent]
+            nearest = None
+            for cell, col in zip(state.box_cells, state.box_letters):
+                if col in costs and level.box_colors[ord(col) - ord('A')] == color and level.goal_at.get(cell) != col:
+                    d = distance(agent_pos, cell)
+                    if d is not None and (nearest is None or d < nearest):
+                        nearest = d
+            approach.append(None if nearest is None else nearest - 1)
+        return approach
+
+    def delivery(self, state, costs):
+        '''
+        By color, the most steps any goal of its letters without a box on it needs before one can be there: the
+        least over the boxes of the letter and the agents of the color of the steps to get next to the box and the
+        steps of the box to the goal. The matching alone misses these when the nearest boxes are not the ones to
+        move, as when a box is next to the agent but far from every goal.
+        '''
+        level = state.level
+        distance = self.distances.distance
+        # Steps until an agent of its color is next to each box of a letter with unsatisfied goals.
+        reach = {}
+        for cell, letter in zip(state.box_cells, state.box_letters):
+            if costs.get(letter):
+                color = level.box_colors[ord(letter) - ord('A')]
+                nearest = None
+                for agent, agent_pos in enumerate(state.agents):
+                    if level.agent_colors[agent] == color:
+                        d = distance(agent_pos, cell)
+                        if d is not None and (nearest is None or d < nearest):
+                            nearest = d
+                if nearest is not None:
+                    reach[cell] = max(nearest - 1, 0)
+        steps = {}
+        for letter, cost in costs.items():
+            if not cost:
+                continue
+            color = level.box_colors[ord(letter) - ord('A')]
+            for goal, field in zip(level.goals_by_letter[letter], self.box_goal_fields[letter]):
+                if state.box_at(goal) == letter:
+                    continue
+                best = None
+                for cell, d in reach.items():
+                    if field[cell] >= 0 and state.box_at(cell) == letter and (best is None or d + field[cell] < best):
+                        best = d + field[cell]
+                if best is not None and best > steps.get(color, 0):
+                    steps[color] = best
+        return steps
+
+    def match_letter(self, state, letter):
+        '''The least total distance from the boxes of letter to its goals when each goal gets a distinct box.'''
+        boxes = tuple(cell for cell, col in zip(state.box_cells, state.box_letters) if col == letter)
+        key = (self.level.goals_by_letter[letter], boxes)
+        cost = self.cached(key)
+        if cost is None:
+            fields = self.box_goal_fields[letter]
+            unreachable = self.unreachable
+            cost = min_cost_assignment(
+                [[field[cell] if field[cell] >= 0 else unreachable for field in fields] for cell in boxes]
+            )[0]
+            self.cache(key, cost)
+        return cost
+
+    def cached(self, key):
+        cache = HeuristicDijkstra.box_cache
+        if cache is None:
+            return None
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+    def cache(self, key, value):
+        cache = HeuristicDijkstra.box_cache
+        if cache is None:
+            return
+        cache[key] = value
+        if len(cache) > HeuristicDijkstra.BOX_CACHE_SIZE:
+            cache.popitem(last=False)
+
+    def agent_to_box(self, state):
+        '''The distances from the agent to every box of the single goal's letter.'''
+        letter = self.single_goal_letter
+        agent_pos = state.agents[0]
+        distance = self.distances.distance
         agent_to_box_h = 0
-        box_to_agent_h = 0
-        #If single box and single goal
-        #agent to box
-        for row_pos, row in enumerate(state.boxes):
-            # print("this is before 2nd loop", find_boxes,file=sys.stderr)
-            for col_pos, col in enumerate(row):
-                if col == goal_letter:
-                    box_pos = (col_pos, row_pos)
-                    goal_pos = goal[col]
-                    agent_pos = (agent_col,agent_row)
-                    if box_pos in self.pre_processed_map[goal_pos]:
-                        agent_to_box_h+=self.pre_processed_map[goal_pos][box_pos]
-                    if box_pos in self.pre_processed_map[agent_pos]:
-                        agent_to_box_h+=self.pre_processed_map[agent_pos][box_pos]
-                    else:
-                        continue
-        return agent_to_box_h+box_to_agent_h
+        for cell, col in zip(state.box_cells, state.box_letters):
+            if col == letter:
+                d = distance(agent_pos, cell)
+                if d is not None:
+                    agent_to_box_h+=d
+        return agent_to_box_h
+
+    def single_goal(self, state):
+        '''
+        The distances from the single goal to every box of its letter (none for an agent goal), to which h adds
+        agent_to_box. It is kept in state.h_cache and updated from the parent's for the one box an action can move.
+        '''
+        letter = self.single_goal_letter
+        field = self.single_goal_field
+        parent = state.parent
+        if parent is not None and parent.h_cache is not None and state.joint_action is not None:
+            goal_to_box_h = parent.h_cache
+            action = state.joint_action[0]
+            _, box_from, box_to = state.level.transitions[action][parent.agents[0]]
+            if box_from >= 0 and state.box_at(box_to) == letter:
+                goal_to_box_h += max(field[box_to], 0) - max(field[box_from], 0)
+        else:
+            boxes = tuple(cell for cell, col in zip(state.box_cells, state.box_letters) if col == letter)
+            key = (self.find_goals[letter], boxes)
+            goal_to_box_h = self.cached(key)
+            if goal_to_box_h is None:
+                goal_to_box_h = sum(max(field[cell], 0) for cell in boxes)
+                self.cache(key, goal_to_box_h)
+        state.h_cache = goal_to_box_h
+
+        return goal_to_box_h
+
+    def h_batch(self, states) -> 'list':
+        '''
+        h of all the children of an expansion, one state at a time: a NumPy gather of the agent-to-box distances
+        costs more than the lookups it replaces for the few children and boxes of real levels.
+        '''
+        return [self.h(state) for state in states]
+
+    def f_batch(self, states) -> 'list':
+        return [state.g + h for state, h in zip(states, self.h_batch(states))]
 
 
 class HeuristicAStar(Heuristic):
-    def __init__(self, initial_state: 'State'):
-        super().__init__(initial_state)
+    def __init__(self, initial_state: 'State', estimate=None):
+        super().__init__(initial_state, estimate)
 
     def f(self, state: 'State') -> 'int':
         return state.g + self.h(state)
 
+    def f_batch(self, states) -> 'list':
+        return [state.g + h for state, h in zip(states, self.h_batch(states))]
+
     def __repr__(self):
         return 'A* evaluation'
 
 class HeuristicWeightedAStar(Heuristic):
-    def __init__(self, initial_state: 'State', w: 'int'):
-        super().__init__(initial_state)
+    def __init__(self, initial_state: 'State', w: 'int', estimate=None):
+        super().__init__(initial_state, estimate)
         self.w = w
 
     def f(self, state: 'State') -> 'int':
         return state.g + self.w * self.h(state)
 
+    def f_batch(self, states) -> 'list':
+        return [state.g + self.w * h for state, h in zip(states, self.h_batch(states))]
+
     def __repr__(self):
         return 'WA*({}) evaluation'.format(self.w)
 
 class HeuristicGreedy(Heuristic):
-    def __init__(self, initial_state: 'State'):
-        super().__init__(initial_state)
+    def __init__(self, initial_state: 'State', estimate=None):
+        super().__init__(initial_state, estimate)
 
     def f(self, state: 'State') -> 'int':
         return self.h(state)
 
+    def f_batch(self, states) -> 'list':
+        return self.h_batch(states)
+
     def __repr__(self):
         return 'greedy evaluation'
+
+class HeuristicDepth(Heuristic):
+    def __init__(self, initial_state: 'State'):
+        super().__init__(initial_state)
+
+    def h(self, state: 'State') -> 'int':
+        # No estimate, so that IDA* bounds only the depth: iterative-deepening depth-first search.
+        return 0
+
+    def f(self, state: 'State') -> 'int':
+        return state.g
+
+    def __repr__(self):
+        return 'depth-first search'
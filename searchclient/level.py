@@ -0,0 +1,188 @@
+import random
+from collections import deque
+
+from action import Action, ActionType
+
+
+class Level:
+    """
+    The static part of a level: walls, goals and colors, plus tables precomputed once per cell.
+
+    Cells are numbered row-major from the top-left corner, cell = row * num_cols + col, and every
+    state of a search references the same Level instead of copying, hashing or comparing its data.
+    A Level is never modified after construction; use derive() to get a variant with other goals or colors.
+    """
+
+    def __init__(self, walls, goals, agent_colors, box_colors, seed: "int" = 1, keys=None):
+        """
+        walls is a grid of booleans and goals a grid of goal characters ('' for no goal), both indexed (row, col).
+        agent_colors and box_colors are indexed by agent number and by box letter - 'A', None for the agents and
+        letters not in the level.
+        keys are the (agent_keys, box_keys) of a level of the same size and colors to share, see Preprocessor.
+        """
+        self.num_rows = len(walls)
+        self.num_cols = max(len(row) for row in walls)
+        self.num_cells = self.num_rows * self.num_cols
+        self.positions = tuple(divmod(cell, self.num_cols) for cell in range(self.num_cells))
+
+        self.walls = bytearray(self.num_cells)
+        for row, line in enumerate(walls):
+            for col, wall in enumerate(line):
+                if wall:
+                    self.walls[row * self.num_cols + col] = 1
+
+        self.agent_colors = tuple(agent_colors)
+        self.box_colors = tuple(box_colors)
+        self._set_goals(
+            {
+                row * self.num_cols + col: goal
+                for row, line in enumerate(goals)
+                for col, goal in enumerate(line)
+                if goal != ""
+            }
+        )
+
+        # Zobrist keys for every (agent, cell) and (box letter, cell) pair of the agents and letters with a color,
+        # see State.__hash__.
+        if keys is None:
+            rng = random.Random(seed)
+            agent_keys = [
+                None if color is None else [rng.getrandbits(64) for _ in range(self.num_cells)]
+                for color in self.agent_colors
+            ]
+            box_keys = {
+                chr(ord("A") + letter): [rng.getrandbits(64) for _ in range(self.num_cells)]
+                for letter, color in enumerate(self.box_colors)
+                if color is not None
+            }
+            keys = agent_keys, box_keys
+        self.agent_keys, self.box_keys = keys
+
+        self.neighbours = tuple(
+            tuple(
+                neighbour
+                for neighbour in (
+                    self._step(cell, -1, 0),
+                    self._step(cell, 1, 0),
+                    self._step(cell, 0, 1),
+                    self._step(cell, 0, -1),
+                )
+                if neighbour is not None
+            )
+            for cell in range(self.num_cells)
+        )
+        self.transitions = {action: self._transition_table(action) for action in Action}
+        # Results of analyses of the walls, shared with the levels derived from this one (see live_cells).
+        self.memo = {}
+
+    def _set_goals(self, goal_at: "{int: str}"):
+        self.goal_at = goal_at
+        self.goals = tuple(sorted(goal_at.items()))
+        goals_by_letter = {}
+        for cell, letter in self.goals:
+            goals_by_letter.setdefault(letter, []).append(cell)
+        self.goals_by_letter = {letter: tuple(cells) for letter, cells in goals_by_letter.items()}
+
+    def _step(self, cell: "int", row_delta: "int", col_delta: "int") -> "int":
+        """Returns the cell next to cell in the given direction, or None if it is a wall or outside the level."""
+        row, col = self.positions[cell]
+        row += row_delta
+        col += col_delta
+        if not (0 <= row < self.num_rows and 0 <= col < self.num_cols):
+            return None
+        neighbour = row * self.num_cols + col
+        if self.walls[neighbour]:
+            return None
+        return neighbour
+
+    def _transition_table(self, action: "Action") -> "[(int, int, int), ...]":
+        """
+        For every cell, the (agent destination, box source, box destination) cells of action performed by an agent
+        standing there, with -1 for the box cells of NoOp and Move. None where one of the cells is a wall.
+        """
+        table = []
+        for cell in range(self.num_cells):
+            if self.walls[cell]:
+                table.append(None)
+                continue
+            destination = self._step(cell, action.agent_row_delta, action.agent_col_delta)
+            if destination is None:
+                table.append(None)
+            elif action.type is ActionType.Push:
+                box_destination = self._step(destination, action.box_row_delta, action.box_col_delta)
+                table.append(None if box_destination is None else (destination, destination, box_destination))
+            elif action.type is ActionType.Pull:
+                box_source = self._step(cell, -action.box_row_delta, -action.box_col_delta)
+                table.append(None if box_source is None else (destination, box_source, cell))
+            else:
+                table.append((destination, -1, -1))
+        return table
+
+    def live_cells(self, letter: "str") -> "bytearray":
+        """
+        Marks the cells from which a box of letter can still be brought to one of its goals; the others are dead
+        squares. Boxes and agents are ignored, so a box on a dead square can never reach a goal.
+        A box moves from x to a neighbour y by a push if x has another free neighbour for the agent to push from
+        (pushes may turn corners), or by a pull if y has another free neighbour for the agent to back into, and the
+        live cells are found backwards from the goals.
+        """
+        goals = self.goals_by_letter.get(letter, ())
+        key = ("live", goals)
+        live = self.memo.get(key)
+        if live is not None:
+            return live
+        neighbours = self.neighbours
+        live = bytearray(self.num_cells)
+        for goal in goals:
+            live[goal] = 1
+        queue = deque(goals)
+        while queue:
+            cell = queue.popleft()
+            for box in neighbours[cell]:
+                if live[box]:
+                    continue
+                if len(neighbours[box]) > 1 or len(neighbours[cell]) > 1:
+                    live[box] = 1
+                    queue.append(box)
+        self.memo[key] = live
+        return live
+
+    def cell(self, row: "int", col: "int") -> "int":
+        return row * self.num_cols + col
+
+    def wall_rows(self) -> "[[bool, ...], ...]":
+        """The walls as a grid of booleans indexed (row, col)."""
+        return [
+            [bool(self.walls[row * self.num_cols + col]) for col in range(self.num_cols)]
+            for row in range(self.num_rows)
+        ]
+
+    def goal_rows(self) -> "[[str, ...], ...]":
+        """The goals as a grid of goal characters indexed (row, col)."""
+        grid = [["" for _ in range(self.num_cols)] for _ in range(self.num_rows)]
+        for cell, letter in self.goals:
+            row, col = self.positions[cell]
+            grid[row][col] = letter
+        return grid
+
+    def derive(self, goals: "{int: str}" = None, agent_colors=None, box_colors=None) -> "Level":
+        """
+        Returns a level with the same walls and precomputed tables but other goals (cell -> goal character) or colors.
+        Used for the sub-problems of CBS and the steps of sequential CBS.
+        """
+        level = Level.__new__(Level)
+        level.__dict__.update(self.__dict__)
+        if goals is not None:
+            level._set_goals(dict(goals))
+        if agent_colors is not None:
+            level.agent_colors = tuple(agent_colors)
+        if box_colors is not None:
+            level.box_colors = tuple(box_colors)
+        return level
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # Levels are immutable, so copies of states and CBS nodes can share them.
+        return self
@@ -0,0 +1,62 @@
+import numpy as np
+
+
+def min_cost_assignment(cost) -> "(int, [(int, int), ...])":
+    """
+    Solves the assignment problem on a (rectangular) matrix of costs with the Hungarian method: every row is
+    matched to a distinct column (or every column to a distinct row, whichever are fewer) at the least total cost.
+    Returns the total cost and the matched (row, column) pairs.
+
+    This is the O(n^2 m) shortest-augmenting-path formulation with potentials u and v, where the scan over the
+    columns in each step is done with NumPy.
+    """
+    cost = np.asarray(cost, dtype=np.float64)
+    if cost.size == 0:
+        return 0, []
+    transposed = cost.shape[0] > cost.shape[1]
+    if transposed:
+        cost = cost.T
+    num_rows, num_cols = cost.shape
+
+    if num_rows == 1:
+        col = int(np.argmin(cost[0]))
+        pairs = [(0, col)]
+    else:
+        # Index 0 of u, v, match and way is a sentinel; rows and columns are numbered from 1 below.
+        u = np.zeros(num_rows + 1)
+        v = np.zeros(num_cols + 1)
+        match = np.zeros(num_cols + 1, dtype=np.int64)  # Row matched to each column, 0 for none.
+        way = np.zeros(num_cols + 1, dtype=np.int64)
+        for row in range(1, num_rows + 1):
+            match[0] = row
+            col0 = 0
+            min_v = np.full(num_cols + 1, np.inf)
+            used = np.zeros(num_cols + 1, dtype=bool)
+            while True:
+                used[col0] = True
+                row0 = match[col0]
+                free = ~used[1:]
+                reduced = cost[row0 - 1] - u[row0] - v[1:]
+                better = free & (reduced < min_v[1:])
+                min_v[1:][better] = reduced[better]
+                way[1:][better] = col0
+                candidates = np.where(free, min_v[1:], np.inf)
+                col1 = int(np.argmin(candidates)) + 1
+                delta = candidates[col1 - 1]
+                u[match[used]] += delta
+                v[used] -= delta
+                min_v[1:][free] -= delta
+                col0 = col1
+                if match[col0] == 0:
+                    break
+            # Augment along the alternating path back to the sentinel.
+            while col0:
+                col1 = way[col0]
+                match[col0] = match[col1]
+                col0 = col1
+        pairs = [(int(match[col]) - 1, col - 1) for col in range(1, num_cols + 1) if match[col]]
+
+    total = sum(cost[row, col] for row, col in pairs)
+    if transposed:
+        pairs = [(col, row) for row, col in pairs]
+    return int(round(total)), sorted(pairs)
@@ -0,0 +1,104 @@
+from conflict import ConstraintTable
+
+
+class MDD:
+    """
+    Multi-valued decision diagram of a single-agent sub-problem: for every time step, the cells the agent can be in
+    on some plan of exactly the given length that satisfies the constraints (NoOps included, so shorter plans count
+    as well). A level with a single cell is one the agent cannot avoid without a longer plan.
+
+    The plans are enumerated over the full states of the sub-problem, boxes included, forward from the initial state
+    breadth-first and pruned by a lower bound on the remaining cost, then backward from the goal states at the last
+    level. If more than max_states states would be needed, levels is None and the agent counts as unconstrained.
+    """
+
+    # Default bound on the states of one MDD.
+    MAX_STATES = 1 << 15
+
+    def __init__(self, sa_state: "State", constraints, cost: "int", distances, max_states: "int" = MAX_STATES):
+        self.cost = cost
+        self.levels = None
+        level = sa_state.level
+        self.constraints = ConstraintTable.compile(constraints, level)
+        self.goal_fields = [
+            (cell, letter, distances.field(cell)) for cell, letter in level.goals if "A" <= letter <= "Z"
+        ]
+        agent_goals = level.goals_by_letter.get("0")
+        self.agent_goal_field = distances.field(agent_goals[0]) if agent_goals else None
+        self._build(sa_state, max_states)
+
+    def lower_bound(self, state: "State") -> "int":
+        """
+        Actions still needed from state: every box goal needs at least the steps of its nearest box of the letter,
+        every action moves one box one step at most, and the agent must walk to its goal. None if a goal is out of
+        reach.
+        """
+        box_steps = 0
+        for goal, letter, field in self.goal_fields:
+            nearest = None
+            for cell, col in zip(state.box_cells, state.box_letters):
+                if col == letter and field[cell] >= 0 and (nearest is None or field[cell] < nearest):
+                    nearest = field[cell]
+            if nearest is None:
+                return None
+            box_steps += nearest
+        agent_steps = 0
+        if self.agent_goal_field is not None:
+            agent_steps = self.agent_goal_field[state.agents[0]]
+            if agent_steps < 0:
+                return None
+        return max(box_steps, agent_steps)
+
+    def _build(self, initial_state: "State", max_states: "int"):
+        constraints = self.constraints
+        layers = [{initial_state: []}]
+        num_states = 1
+        for time in range(self.cost):
+            layer = {}
+            remaining = self.cost - time - 1
+            for state in layers[-1]:
+                for child in state.get_expanded_states(constraints):
+                    parents = layer.get(child)
+                    if parents is None:
+                        bound = self.lower_bound(child)
+                        if bound is None or bound > remaining:
+                            continue
+                        parents = layer[child] = []
+                        num_states += 1
+                        if num_states > max_states:
+                            return
+                    parents.append(state)
+            layers.append(layer)
+
+        # Keep the states on a plan: the goal states of the last level and, backwards, their parents.
+        kept = {state for state in layers[-1] if state.is_goal_state(constraints)}
+        if not kept:
+            return
+        levels = [None for _ in layers]
+        for time in range(len(layers) - 1, 0, -1):
+            levels[time] = {state.agents[0] for state in kept}
+            kept = {parent for state in kept for parent in layers[time][state]}
+        levels[0] = {state.agents[0] for state in kept}
+        self.levels = levels
+
+    def cells_at(self, time: "int") -> "{int, ...}":
+        """The cells the agent can be in at time, after its plan the cells it can end in. None if unknown."""
+        if self.levels is None:
+            return None
+        return self.levels[min(time, len(self.levels) - 1)]
+
+    def is_cardinal(self, constraints, level: "Level") -> "bool":
+        """
+        True if constraints, (cell, time) pairs as in Conflict.constraints, block a whole level of the MDD, so that
+        every plan of this length violates them and the agent's cost must rise.
+        """
+        if self.levels is None:
+            return False
+        blocked = {}
+        for (row, col), time in constraints:
+            # A constraint at time restricts the cell the agent is in after its action at time.
+            blocked.setdefault(time + 1, set()).add(level.cell(row, col))
+        for time, cells in blocked.items():
+            if time >= 0 and self.cells_at(time) <= cells:
+                return True
+        return False
@@ -1,10 +1,83 @@
 from math import inf
+import time
 import psutil
 
 max_usage = inf
+# Fraction of max_usage above which searches start shedding memory, see MemoryGovernor.
+soft_fraction = 0.8
 _process = psutil.Process()
 
 def get_usage() -> 'float':
     ''' Returns memory usage of current process in MB. '''
     global _process
     return _process.memory_info().rss / (1024*1024)
+
+
+# Results of MemoryGovernor.check.
+OK = 0
+SOFT = 1
+HARD = 2
+
+class MemoryGovernor:
+    '''
+    Watches the memory usage of a search without reading it on every expansion.
+
+    The RSS is sampled after sample_every new nodes or sample_interval seconds, whichever comes first,
+    and the growth per node between samples predicts how close the next limit is, so that sampling gets
+    more frequent as a limit approaches. Nodes that the search drops are counted as free, since the
+    interpreter reuses their memory even though the RSS does not shrink.
+    '''
+
+    # Calls to check between looks at the node count and the clock.
+    CHECK_EVERY = 64
+
+    def __init__(self, hard_limit: 'float' = None, soft_limit: 'float' = None,
+                 sample_every: 'int' = 4096, sample_interval: 'float' = 1.0):
+        self.hard_limit = max_usage if hard_limit is None else hard_limit
+        self.soft_limit = self.hard_limit * soft_fraction if soft_limit is None else soft_limit
+        self.sample_every = sample_every
+        self.sample_interval = sample_interval
+
+        self.usage = get_usage()
+        self.mb_per_node = 0.0
+        self._peak_nodes = 0
+        self._peak_usage = self.usage
+        self._countdown = MemoryGovernor.CHECK_EVERY
+        self._next_nodes = sample_every
+        self._next_time = time.perf_counter() + sample_interval
+
+    def check(self, nodes: 'int') -> 'int':
+        ''' Called once per expansion with the number of nodes the search holds. Returns OK, SOFT or HARD. '''
+        self._countdown -= 1
+        if self._countdown:
+            return OK
+        self._countdown = MemoryGovernor.CHECK_EVERY
+        if nodes < self._next_nodes and time.perf_counter() < self._next_time:
+            return OK
+        return self.sample(nodes)
+
+    def sample(self, nodes: 'int') -> 'int':
+        ''' Reads the RSS and returns whether it is above the soft or hard limit. '''
+        rss = get_usage()
+        if nodes > self._peak_nodes:
+            if rss > self._peak_usage:
+                self.mb_per_node = (rss - self._peak_usage) / (nodes - self._peak_nodes)
+            self._peak_nodes = nodes
+            self._peak_usage = rss
+        self.usage = rss - self.mb_per_node * (self._peak_nodes - nodes)
+
+        if self.usage > self.hard_limit:
+            status = HARD
+        elif self.usage > self.soft_limit:
+            status = SOFT
+        else:
+            status = OK
+
+        # Sample again before the nodes at the current growth rate could use half the headroom to the next limit.
+        step = self.sample_every
+        if self.mb_per_node > 0:
+            headroom = (self.hard_limit if status else self.soft_limit) - self.usage
+            step = max(MemoryGovernor.CHECK_EVERY, int(min(step, headroom / self.mb_per_node / 2)))
+        self._next_nodes = nodes + step
+        self._next_time = time.perf_counter() + self.sample_interval
+        return status
@@ -1,113 +1,243 @@
+from level import Level
 from state import State
 import sys
-import heapq
+import os
+import hashlib
+from array import array
+from collections import OrderedDict, deque
+import numpy as np
+
+# Memory in MB the distances of a level may take: the full DistanceTable if it fits, else a DistanceOracle.
+DISTANCE_MEMORY = 256.0
+
+# Directory of the on-disk cache of preprocessed level data (see cached), None to disable it.
+cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "searchclient")
 
 class Preprocessor:
     def __init__(self, initial_state: State) -> None:
         self.state = initial_state
 
     def boxes_to_walls(self):
-        box_colors = set(self.state.box_colors)
-        agent_colors = set(self.state.agent_colors)
+        level = self.state.level
+        box_colors = set(level.box_colors)
+        agent_colors = set(level.agent_colors)
         unassigned_boxes = box_colors - agent_colors
-        unassigned_letters = [chr(ord('A') + i) for i in range(26) if self.state.box_colors[i] in unassigned_boxes]
+        unassigned_letters = [chr(ord('A') + i) for i in range(26) if level.box_colors[i] in unassigned_boxes]
         # print(unassigned_letters, file=sys.stderr, flush=True)
-        for letter in unassigned_letters:
-            for row in range(len(self.state.boxes)):
-                for col in range(len(self.state.boxes[0])):
-                    if self.state.boxes[row][col] == letter:
-                        self.state.boxes[row][col] = ''
-                        self.state.walls[row][col] = True
+        walls = level.wall_rows()
+        boxes = {}
+        for cell, letter in zip(self.state.box_cells, self.state.box_letters):
+            if letter in unassigned_letters:
+                row, col = level.positions[cell]
+                walls[row][col] = True
+            else:
+                boxes[cell] = letter
+        # Only the walls change, so the Zobrist keys stay valid.
+        level = Level(
+            walls, level.goal_rows(), level.agent_colors, level.box_colors, keys=(level.agent_keys, level.box_keys)
+        )
+        self.state = State(level, self.state.agents, boxes)
+
+    def find_dead_squares(self):
+        # Later searches on this level and the levels derived from it share the result, see Level.live_cells.
+        for letter in self.state.level.goals_by_letter:
+            if "A" <= letter <= "Z":
+                self.state.level.live_cells(letter)
 
     def preprocess(self) -> State:
         self.boxes_to_walls()
+        self.find_dead_squares()
         return self.state
 
 
-class Dijkstra():
-    def __init__(self, initial_state: 'State') -> None:
-        self.state = initial_state
-        self.agent_colors = self.state.agent_colors
-        self.agent_row = self.state.agent_rows
-        self.agent_col = self.state.agent_cols
-
-        self.box_colors = self.state.box_colors
-        self.box_locations = self.state.boxes
-        self.walls = self.state.walls
-        self.agent_to_box_h = 0
-        self.box_to_goal_h = 0
-        self.g = 0
-        self.h = 0
-        self.f = self.g+self.h
-
-    def create_valid_squares_dic(self) -> dict:
-        valid_squares = {(j,i): float('inf') for i,row in enumerate(self.walls) for j,col in enumerate(row) if col is False}
-        return valid_squares
-
-    def adjacency_dict(self, valid_dic: dict) -> dict:
-        valid_dic = {key:{} for key in valid_dic}
-        for i,j in valid_dic:
-            vertex = (i,j)
-            up = (i, j+1)
-            down = (i, j-1)
-            left = (i-1, j)
-            right = (i+1, j)
-
-            if up in valid_dic:
-                if vertex in valid_dic[up]:
-                    if vertex in valid_dic[up]:
-                        pass
-                else:
-                    valid_dic[vertex][up] = 1
-                    valid_dic[up][vertex] = 1
-            if down in valid_dic:
-                if vertex in valid_dic[down]:
-                    pass
-                else:
-                    valid_dic[vertex][down] = 1
-                    valid_dic[down][vertex] = 1
-            if left in valid_dic:
-                if vertex in valid_dic[left]:
-                    pass
-                else:
-                    valid_dic[vertex][left] = 1
-                    valid_dic[left][vertex] = 1
-            if right in valid_dic:
-                if vertex in valid_dic[right]:
-                    pass
-                else:
-                    valid_dic[vertex][right] = 1
-                    valid_dic[right][vertex] = 1
-        return valid_dic
-
-
-    def dijkstra(self, start: tuple[int, int], distance: dict) -> dict:
-        #start is a tuple containing x,y values, i.e. col,rows.
-        graph = self.adjacency_dict(distance)
-        dist = distance.copy()
-        dist[start] = 0
-        queue = [(0, start)]
+class DistanceTable:
+    """
+    Shortest-path distances between every pair of free cells, for agents and boxes alike, ignoring boxes and agents.
+
+    All cells are searched from at once by a breadth-first search over (source, cell) pairs held in NumPy arrays,
+    which on a 4-connected grid of unit-cost moves gives the same distances as Dijkstra from every cell.
+    The result is an int16 matrix over the free cells only (walls would dominate the matrix of large levels),
+    queried by level cell number through distance(). A matrix already computed for the same walls can be passed in.
+    """
+
+    UNREACHABLE = -1
+
+    def __init__(self, level: Level, matrix: np.ndarray = None) -> None:
+        self.level = level
+        free = np.flatnonzero(np.frombuffer(bytes(level.walls), dtype=np.uint8) == 0)
+        # Row and column of the matrix of every level cell, -1 for walls.
+        index = np.full(level.num_cells, -1, dtype=np.int64)
+        index[free] = np.arange(len(free))
+        self.index = index.tolist()
+        self.free = free
+        self.matrix = self._all_pairs(free) if matrix is None else matrix
+
+    def _all_pairs(self, free: np.ndarray) -> np.ndarray:
+        level = self.level
+        num_free = len(free)
+        # Matrix index of the neighbour of every free cell in each direction, -1 where there is a wall.
+        steps = (-level.num_cols, level.num_cols, 1, -1)
+        neighbours = []
+        for step in steps:
+            neighbour = np.full(num_free, -1, dtype=np.int64)
+            for i, cell in enumerate(free.tolist()):
+                if cell + step in level.neighbours[cell]:
+                    neighbour[i] = self.index[cell + step]
+            neighbours.append(neighbour)
+
+        matrix = np.full((num_free, num_free), DistanceTable.UNREACHABLE, dtype=np.int16)
+        flat = matrix.reshape(-1)
+        sources = np.arange(num_free)
+        # The frontier as flat matrix indices source * num_free + cell.
+        frontier = sources * num_free + sources
+        flat[frontier] = 0
+        distance = 0
+        while frontier.size:
+            distance += 1
+            source, cell = np.divmod(frontier, num_free)
+            source *= num_free
+            reached = []
+            # Frontier pairs are distinct, so the pairs reached in one direction are too, and marking them before
+            # the next direction keeps the new frontier free of duplicates without sorting.
+            for neighbour in neighbours:
+                step = neighbour[cell]
+                valid = step >= 0
+                pairs = source[valid] + step[valid]
+                pairs = pairs[flat[pairs] == DistanceTable.UNREACHABLE]
+                flat[pairs] = distance
+                reached.append(pairs)
+            frontier = np.concatenate(reached)
+        return matrix
+
+    def field(self, source: int) -> list:
+        """The distance from source to every cell, -1 where there is no path."""
+        field = np.full(self.level.num_cells, DistanceTable.UNREACHABLE, dtype=np.int16)
+        if self.index[source] >= 0:
+            field[self.free] = self.matrix[self.index[source]]
+        return field.tolist()
+
+    def distance(self, a: int, b: int) -> int:
+        """The distance between cells a and b, or None if there is no path between them."""
+        i = self.index[a]
+        j = self.index[b]
+        if i < 0 or j < 0:
+            return None
+        d = int(self.matrix[i, j])
+        return None if d == DistanceTable.UNREACHABLE else d
+
 
+class DistanceOracle:
+    """
+    The distances of a DistanceTable computed on demand, for levels where the full table would not fit.
+
+    Each query is answered from the breadth-first field (distances to every cell) of one of its two cells,
+    preferring a cached field and then the goal cell, since heuristics ask about the few goals over and over.
+    Fields of the goal cells are computed up front, and at most max_mb of fields are kept, least recently used
+    evicted first.
+    """
+
+    def __init__(self, level: Level, max_mb: float = DISTANCE_MEMORY) -> None:
+        self.level = level
+        self.max_fields = max(1, int(max_mb * 1024 * 1024 // (2 * level.num_cells)))
+        self.fields = OrderedDict()
+        for cell, _ in level.goals[: self.max_fields]:
+            self.field(cell)
+
+    def field(self, source: int) -> array:
+        """The distance from source to every cell, -1 where there is no path."""
+        if self.level.walls[source]:
+            return array("h", [DistanceTable.UNREACHABLE]) * self.level.num_cells
+        fields = self.fields
+        field = fields.get(source)
+        if field is not None:
+            fields.move_to_end(source)
+            return field
+        neighbours = self.level.neighbours
+        field = array("h", [DistanceTable.UNREACHABLE]) * self.level.num_cells
+        field[source] = 0
+        queue = deque([source])
         while queue:
-            current_distance, current_vertex = heapq.heappop(queue)
-            if current_distance > dist[current_vertex]:
+            cell = queue.popleft()
+            distance = field[cell] + 1
+            for neighbour in neighbours[cell]:
+                if field[neighbour] < 0:
+                    field[neighbour] = distance
+                    queue.append(neighbour)
+        fields[source] = field
+        if len(fields) > self.max_fields:
+            fields.popitem(last=False)
+        return field
+
+    def distance(self, a: int, b: int) -> int:
+        """The distance between cells a and b, or None if there is no path between them."""
+        walls = self.level.walls
+        if walls[a] or walls[b]:
+            return None
+        if a not in self.fields and (b in self.fields or b in self.level.goal_at):
+            a, b = b, a
+        d = self.field(a)[b]
+        return None if d == DistanceTable.UNREACHABLE else d
+
+
+def distances(level: Level, max_mb: float = DISTANCE_MEMORY):
+    """The DistanceTable of level if it takes at most max_mb, else a DistanceOracle capped at max_mb."""
+    num_free = level.num_cells - sum(level.walls)
+    if 2 * num_free * num_free <= max_mb * 1024 * 1024:
+        return DistanceTable(level, cached(level, "distances", lambda: DistanceTable(level).matrix))
+    return DistanceOracle(level, max_mb)
+
+
+def components(level: Level) -> np.ndarray:
+    """The connected component of every cell, numbered from 0 in cell order, -1 for walls."""
+    def label():
+        component = np.full(level.num_cells, -1, dtype=np.int32)
+        count = 0
+        for start in range(level.num_cells):
+            if level.walls[start] or component[start] >= 0:
                 continue
+            component[start] = count
+            queue = deque([start])
+            while queue:
+                cell = queue.popleft()
+                for neighbour in level.neighbours[cell]:
+                    if component[neighbour] < 0:
+                        component[neighbour] = count
+                        queue.append(neighbour)
+            count += 1
+        return component
+
+    return cached(level, "components", label)
+
+
+def walls_key(level: Level) -> str:
+    """A hash of the wall layout of level, which is all the data in the cache depends on."""
+    digest = hashlib.sha1("{}x{}".format(level.num_rows, level.num_cols).encode())
+    digest.update(bytes(level.walls))
+    return digest.hexdigest()
+
 
-            for neighbour, cost in graph[current_vertex].items():
-                new_distance = current_distance+cost
-
-                if new_distance < dist[neighbour]:
-                    dist[neighbour] = new_distance
-                    heapq.heappush(queue, (new_distance, neighbour))
-        delete_keys = []
-        for i,j in dist.items():
-            if isinstance(j, float):
-                delete_keys.append(i)
-        for i in delete_keys:
-            del dist[i]
-        return dist
-
-    def distance_matrix(self):
-        valid = self.create_valid_squares_dic()
-        distance_matrix = {key:self.dijkstra(key, valid) for key in valid}
-        return distance_matrix
\ No newline at end of file
+def cached(level: Level, name: str, compute) -> np.ndarray:
+    """
+    Returns the array compute() returns for the walls of level. It is stored as <cache_dir>/<walls key>/<name>.npy
+    and memory-mapped by later runs on the same walls, which skip the computation. Without a cache directory,
+    or if it cannot be written, the array is just computed.
+    """
+    if not cache_dir:
+        return compute()
+    directory = os.path.join(cache_dir, walls_key(level))
+    path = os.path.join(directory, name + ".npy")
+    try:
+        return np.asarray(np.load(path, mmap_mode="r"))
+    except (OSError, ValueError):
+        pass
+    data = compute()
+    try:
+        os.makedirs(directory, exist_ok=True)
+        # Write under another name first, so that concurrent runs never read a partial file.
+        partial = "{}.{}.tmp".format(path, os.getpid())
+        with open(partial, "wb") as file:
+            np.save(file, data)
+        os.replace(partial, path)
+    except OSError:
+        pass
+    return data
@@ -7,18 +7,22 @@ import copy
 import cProfile
 
 import memory
+import preprocessing
 from color import Color
+from level import Level
 from state import State
 from conflict import Conflict
-from frontier import FrontierBFS, FrontierDFS, FrontierBestFirst, CBSQueue
-from heuristic import HeuristicAStar, HeuristicWeightedAStar, HeuristicGreedy, HeuristicDijkstra
-from graphsearch import search
+from frontier import FrontierBFS, FrontierBestFirst, CBSQueue
+from heuristic import HeuristicAStar, HeuristicWeightedAStar, HeuristicGreedy, HeuristicDepth, HeuristicDijkstra
+from graphsearch import search, ida_search, IDA_TABLE_SIZE
+import cbs_search as cbs
 from cbs_search import cbs_search, sequential_cbs
 
 
 class SearchClient:
     @staticmethod
     def parse_level(server_messages) -> "State":
+        """Parses the level into its static Level and returns the initial State, which references it."""
         # We can assume that the level file is conforming to specification, since the server verifies this.
         # Read domain.
         server_messages.readline()  # #domain
@@ -57,25 +61,22 @@ class SearchClient:
             line = server_messages.readline()
 
         num_agents = 0
-        agent_rows = [None for _ in range(10)]
-        agent_cols = [None for _ in range(10)]
+        agents = [None for _ in range(10)]
         walls = [[False for _ in range(num_cols)] for _ in range(num_rows)]
-        boxes = [["" for _ in range(num_cols)] for _ in range(num_rows)]
+        boxes = {}
         row = 0
         for line in level_lines:
             for col, c in enumerate(line):
                 if "0" <= c <= "9":
-                    agent_rows[ord(c) - ord("0")] = row
-                    agent_cols[ord(c) - ord("0")] = col
+                    agents[ord(c) - ord("0")] = row * num_cols + col
                     num_agents += 1
                 elif "A" <= c <= "Z":
-                    boxes[row][col] = c
+                    boxes[row * num_cols + col] = c
                 elif c == "+":
                     walls[row][col] = True
 
             row += 1
-        del agent_rows[num_agents:]
-        del agent_cols[num_agents:]
+        del agents[num_agents:]
 
         # Read goal state.
         # line is currently "#goal".
@@ -92,14 +93,13 @@ class SearchClient:
 
         # End.
         # line is currently "#end".
-        State.agent_colors = agent_colors
-        State.walls = walls
+        level = Level(walls, goals, agent_colors, box_colors)
         # State.box_colors = box_colors
         # Conflict.constraints = [None for _ in range(num_agents)]
         # Conflict.resolveable = [True for _ in range(num_agents)]
         # print(box_colors, file=sys.stderr)
         # State.goals = goals
-        return State(agent_rows, agent_cols, boxes, goals, box_colors)
+        return State(level, agents, boxes)
 
     @staticmethod
     def print_search_status(
@@ -120,6 +120,27 @@ class SearchClient:
             flush=True,
         )
 
+    @staticmethod
+    def joint_heuristic(initial_state: "State", name: "str", args) -> "HeuristicDijkstra":
+        """
+        The evaluation of joint states named on the command line, None for the goal count.
+        By default the admissible makespan estimate ('max') for A* and IDA*, whose plan length is the makespan, and
+        the more informed sum of costs ('sum') for WA*. Greedy keeps the goal count: states are told apart by their
+        time step, so the plateau around any local minimum of a distance estimate is endless for a search that
+        ignores g, while the goal count makes it breadth-first.
+        """
+        if name is None:
+            if args.astar or args.idastar is not False:
+                name = "max"
+            elif args.wastar is not False:
+                name = "sum"
+            else:
+                name = "goal-count"
+        if name == "goal-count":
+            return None
+        HeuristicDijkstra.distances = preprocessing.distances(initial_state.level)
+        return HeuristicDijkstra(name)
+
     @staticmethod
     def main(args) -> None:
         # Use stderr to print to the console.
@@ -142,18 +163,28 @@ class SearchClient:
 
         # Select search strategy.
         frontier = None
+        estimate = None
+        if args.astar or args.wastar is not False or args.greedy or args.idastar is not False:
+            estimate = SearchClient.joint_heuristic(initial_state, args.heuristic, args)
         if args.bfs:
             frontier = FrontierBFS()
         elif args.dfs:
-            frontier = FrontierDFS()
+            # Depth-first search would never return from the unbounded time dimension, so deepen iteratively.
+            frontier = None
+            heuristic = HeuristicDepth(initial_state)
         elif args.astar:
-            frontier = FrontierBestFirst(HeuristicAStar(initial_state))
+            frontier = FrontierBestFirst(HeuristicAStar(initial_state, estimate), args.tie_breaking or "high-g")
         elif args.wastar is not False:
             frontier = FrontierBestFirst(
-                HeuristicWeightedAStar(initial_state, args.wastar)
+                HeuristicWeightedAStar(initial_state, args.wastar, estimate), args.tie_breaking or "high-g"
             )
         elif args.greedy:
-            frontier = FrontierBestFirst(HeuristicGreedy(initial_state))
+            # States with equal h say nothing about each other, so don't dive into the deepest one.
+            frontier = FrontierBestFirst(HeuristicGreedy(initial_state, estimate), args.tie_breaking or "fifo")
+        elif args.idastar is not False:
+            # IDA* keeps no frontier, the heuristic is all it needs.
+            frontier = None
+            heuristic = HeuristicAStar(initial_state, estimate)
         elif args.cbs:
             frontier = CBSQueue()
         else:
@@ -166,9 +197,14 @@ class SearchClient:
             )
 
         # Search for a plan.
-        print("Starting {}.".format(frontier.get_name()), file=sys.stderr, flush=True)
+        if frontier is None:
+            print("Starting iterative-deepening {}.".format(heuristic), file=sys.stderr, flush=True)
+        else:
+            print("Starting {}.".format(frontier.get_name()), file=sys.stderr, flush=True)
         if args.cbs:
             plan = sequential_cbs(initial_state)
+        elif frontier is None:
+            plan = ida_search(initial_state, heuristic, table_size=IDA_TABLE_SIZE if args.idastar is False else args.idastar)
         else:
             plan = search(initial_state, frontier)
 
@@ -201,13 +237,53 @@ if __name__ == "__main__":
         default=2048.0,
         help="The maximum memory usage allowed in MB (soft limit, default 2048).",
     )
+    parser.add_argument(
+        "--soft-memory",
+        metavar="<fraction>",
+        type=float,
+        default=memory.soft_fraction,
+        help="Fraction of --max-memory above which searches degrade (go greedy, prune the frontier) instead of failing (default 0.8).",
+    )
+
+    parser.add_argument(
+        "--cache-dir",
+        metavar="<dir>",
+        default=preprocessing.cache_dir,
+        help="Directory in which preprocessed level data is cached between runs, empty to disable (default {}).".format(
+            preprocessing.cache_dir
+        ),
+    )
+
+    parser.add_argument(
+        "-od",
+        "--operator-decomposition",
+        action="store_true",
+        dest="operator_decomposition",
+        help="Expand joint states one agent at a time (for -bfs, -astar, -wastar and -greedy).",
+    )
+
+    parser.add_argument(
+        "--tie-breaking",
+        choices=sorted(FrontierBestFirst.TIE_BREAKING),
+        default=None,
+        help="Order of states with equal f in the best-first strategies (default high-g, fifo for greedy).",
+    )
+
+    parser.add_argument(
+        "--heuristic",
+        choices=("goal-count",) + HeuristicDijkstra.COMBINE,
+        default=None,
+        help="Evaluation of joint states for -astar, -wastar, -greedy and -idastar: the number of unsatisfied goals, or "
+        "box-goal matching distances with the agents' costs added up (sum of costs) or maxed (makespan). "
+        "Default max for -astar and -idastar, sum for -wastar and goal-count for -greedy.",
+    )
 
     strategy_group = parser.add_mutually_exclusive_group()
     strategy_group.add_argument(
         "-bfs", action="store_true", dest="bfs", help="Use the BFS strategy."
     )
     strategy_group.add_argument(
-        "-dfs", action="store_true", dest="dfs", help="Use the DFS strategy."
+        "-dfs", action="store_true", dest="dfs", help="Use the (iterative-deepening) DFS strategy."
     )
     strategy_group.add_argument(
         "-astar", action="store_true", dest="astar", help="Use the A* strategy."
@@ -225,14 +301,57 @@ if __name__ == "__main__":
     strategy_group.add_argument(
         "-greedy", action="store_true", dest="greedy", help="Use the Greedy strategy."
     )
+    strategy_group.add_argument(
+        "-idastar",
+        action="store",
+        dest="idastar",
+        nargs="?",
+        type=int,
+        default=False,
+        const=IDA_TABLE_SIZE,
+        metavar="<states>",
+        help="Use the memory-bounded IDA* strategy, optionally with the size of its transposition table.",
+    )
     strategy_group.add_argument(
         "-cbs", action="store_true", dest="cbs", help="Use the cbs strategy."
     )
+    parser.add_argument(
+        "--cbs-low-level",
+        choices=("astar", "idastar", "sipp"),
+        default="astar",
+        help="Single-agent search used by -cbs: time-expanded A*, IDA* or safe interval path planning (default astar).",
+    )
+    parser.add_argument(
+        "--merge-threshold",
+        metavar="<conflicts>",
+        type=int,
+        default=cbs.merge_threshold,
+        help="Conflicts between two agents after which -cbs plans them jointly as a meta-agent, negative to never merge (default {}).".format(
+            cbs.merge_threshold
+        ),
+    )
+
+    parser.add_argument(
+        "--workers",
+        metavar="<processes>",
+        type=int,
+        default=cbs.workers,
+        help="Processes running the low-level searches of -cbs side by side, each with an equal share of --max-memory (default {}).".format(
+            cbs.workers
+        ),
+    )
 
     args = parser.parse_args()
 
     # Set max memory usage allowed (soft limit).
     memory.max_usage = args.max_memory
+    memory.soft_fraction = args.soft_memory
+
+    State.operator_decomposition = args.operator_decomposition
+    cbs.low_level = args.cbs_low_level
+    cbs.merge_threshold = args.merge_threshold
+    cbs.workers = args.workers
+    preprocessing.cache_dir = args.cache_dir or None
 
     # Run client.
     SearchClient.main(args)
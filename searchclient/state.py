@@ -1,85 +1,167 @@
 import random
-from typing import List
 from action import Action, ActionType
-from conflict import Conflict
-from color import Color
+from level import Level
 import sys
 
 
 class State:
     _RNG = random.Random(1)
-
-    def __init__(self, agent_rows, agent_cols, boxes, goals, box_colors: List[Color]):
+    # Expand joint states one agent at a time, see get_expanded_states.
+    operator_decomposition = False
+
+    __slots__ = (
+        "level",
+        "agents",
+        "box_cells",
+        "box_letters",
+        "_box_index",
+        "_agent_index",
+        "parent",
+        "joint_action",
+        "g",
+        "t",
+        "_hash",
+        "_zobrist",
+        "pending",
+        "unsatisfied",
+        "h_cache",
+    )
+
+    def __init__(self, level: "Level", agents, boxes: "{int: str}"):
         """
         Constructs an initial state.
         Arguments are not copied, and therefore should not be modified after being passed in.
 
-        The lists walls, boxes, and goals are indexed from top-left of the level, row-major order (row, col).
+        Positions are cells of the level, numbered from top-left in row-major order: cell = row * level.num_cols + col.
                Col 0  Col 1  Col 2  Col 3
-        Row 0: (0,0)  (0,1)  (0,2)  (0,3)  ...
-        Row 1: (1,0)  (1,1)  (1,2)  (1,3)  ...
-        Row 2: (2,0)  (2,1)  (2,2)  (2,3)  ...
+        Row 0:   0      1      2      3    ...
+        Row 1:   n     n+1    n+2    n+3   ...   (n = level.num_cols)
         ...
 
-        For example, State.walls[2] is a list of booleans for the third row.
-        State.walls[row][col] is True if there's a wall at (row, col).
+        The walls, goals and colors are static and live in the shared Level, see level.py.
 
-        The agent rows, columns, and colors are indexed by the agent number.
-        For example, self.agent_rows[0] is the row location of agent '0'.
+        The agent cells are indexed by the agent number.
+        For example, self.agents[0] is the cell of agent '0'.
+        boxes maps the cell of every box to its letter. The state keeps the boxes as a sorted tuple of
+        cells with a parallel tuple of letters, and State.boxes rebuilds a grid on demand.
 
         Note: The state should be considered immutable after it has been hashed, e.g. added to a dictionary or set.
+        h_cache is the exception: a heuristic may keep a value there from which it evaluates the children incrementally.
         """
-        self._goals = goals
-        self.agent_rows = agent_rows
-        self.agent_cols = agent_cols
-        self.boxes = boxes
+        self.level = level
+        self.agents = tuple(agents)
+        self.box_cells = tuple(sorted(boxes))
+        self.box_letters = tuple(boxes[cell] for cell in self.box_cells)
+        self._box_index = dict(boxes)
+        self._agent_index = None
         self.parent = None
         self.joint_action = None
         self.g = 0
         self.t = 0
         self._hash = None
-        self.box_colors = box_colors
+        self.pending = None
+        self.h_cache = None
+
+        zobrist = 0
+        for agent, cell in enumerate(self.agents):
+            zobrist ^= level.agent_keys[agent][cell]
+        for cell, letter in zip(self.box_cells, self.box_letters):
+            zobrist ^= level.box_keys[letter][cell]
+        self._zobrist = zobrist
+
+        unsatisfied = 0
+        for cell, goal in level.goals:
+            if "A" <= goal <= "Z":
+                if self._box_index.get(cell) != goal:
+                    unsatisfied += 1
+            elif self.agents[ord(goal) - ord("0")] != cell:
+                unsatisfied += 1
+        self.unsatisfied = unsatisfied
+
+    @property
+    def agent_rows(self) -> "(int, ...)":
+        positions = self.level.positions
+        return tuple(positions[cell][0] for cell in self.agents)
+
+    @property
+    def agent_cols(self) -> "(int, ...)":
+        positions = self.level.positions
+        return tuple(positions[cell][1] for cell in self.agents)
+
+    @property
+    def boxes(self) -> "[[str, ...], ...]":
+        """Grid view of the boxes indexed (row, col), rebuilt on every access. Avoid in hot code, use box_at instead."""
+        grid = [["" for _ in range(self.level.num_cols)] for _ in range(self.level.num_rows)]
+        for cell, letter in zip(self.box_cells, self.box_letters):
+            row, col = self.level.positions[cell]
+            grid[row][col] = letter
+        return grid
+
+    def _box_lookup(self) -> "{int: str}":
+        if self._box_index is None:
+            self._box_index = dict(zip(self.box_cells, self.box_letters))
+        return self._box_index
+
+    def _agent_lookup(self) -> "{int: int}":
+        if self._agent_index is None:
+            self._agent_index = {cell: agent for agent, cell in enumerate(self.agents)}
+        return self._agent_index
 
     def apply_action(self, joint_action: "[Action, ...]") -> "State":
         """
         Returns the state resulting from applying joint_action in this state.
         Precondition: Joint action must be applicable and non-conflicting in this state.
         """
-        # Copy this state.
-        copy_agent_rows = self.agent_rows[:]
-        copy_agent_cols = self.agent_cols[:]
-        copy_boxes = [row[:] for row in self.boxes]
+        level = self.level
+        goal_at = level.goal_at
+        # Copy the agent cells; the boxes are shared with this state unless one of them moves.
+        copy_agents = list(self.agents)
+        copy_boxes = None
+        copy_zobrist = self._zobrist
+        # Only the cells an action vacates or occupies can change whether their goal is satisfied.
+        copy_unsatisfied = self.unsatisfied
 
         # Apply each action.
         for agent, action in enumerate(joint_action):
             if action.type is ActionType.NoOp:
-                pass
-
-            elif action.type is ActionType.Move:
-                copy_agent_rows[agent] += action.agent_row_delta
-                copy_agent_cols[agent] += action.agent_col_delta
-
-            elif action.type is ActionType.Push:
-                copy_agent_rows[agent] += action.agent_row_delta
-                copy_agent_cols[agent] += action.agent_col_delta
-
-                copy_boxes[copy_agent_rows[agent] + action.box_row_delta][
-                    copy_agent_cols[agent] + action.box_col_delta
-                ] = copy_boxes[copy_agent_rows[agent]][copy_agent_cols[agent]]
-                copy_boxes[copy_agent_rows[agent]][copy_agent_cols[agent]] = ""
+                continue
 
-            elif action.type is ActionType.Pull:
-                #print("hereahdjashdajhsd",action.agent_col_delta, file = sys.stderr)
-                copy_boxes[copy_agent_rows[agent]][copy_agent_cols[agent]] = copy_boxes[
-                    copy_agent_rows[agent] - action.box_row_delta
-                ][copy_agent_cols[agent] - action.box_col_delta]
-                copy_boxes[copy_agent_rows[agent] - action.box_row_delta][
-                    copy_agent_cols[agent] - action.box_col_delta
-                ] = ""
-                copy_agent_rows[agent] += action.agent_row_delta
-                copy_agent_cols[agent] += action.agent_col_delta
+            cell = copy_agents[agent]
+            destination, box_from, box_to = level.transitions[action][cell]
+            copy_agents[agent] = destination
+            agent_keys = level.agent_keys[agent]
+            copy_zobrist ^= agent_keys[cell] ^ agent_keys[destination]
+            if goal_at:
+                agent_goal = chr(ord("0") + agent)
+                copy_unsatisfied += (goal_at.get(cell) == agent_goal) - (goal_at.get(destination) == agent_goal)
 
-        copy_state = State(copy_agent_rows, copy_agent_cols, copy_boxes, self._goals, self.box_colors)
+            if box_from < 0:
+                continue
+            if copy_boxes is None:
+                copy_boxes = dict(self._box_lookup())
+            letter = copy_boxes.pop(box_from)
+            copy_boxes[box_to] = letter
+            box_keys = level.box_keys[letter]
+            copy_zobrist ^= box_keys[box_from] ^ box_keys[box_to]
+            copy_unsatisfied += (goal_at.get(box_from) == letter) - (goal_at.get(box_to) == letter)
+
+        copy_state = State.__new__(State)
+        copy_state.level = level
+        copy_state.agents = tuple(copy_agents)
+        if copy_boxes is None:
+            copy_state.box_cells = self.box_cells
+            copy_state.box_letters = self.box_letters
+            copy_state._box_index = self._box_index
+        else:
+            copy_state.box_cells = tuple(sorted(copy_boxes))
+            copy_state.box_letters = tuple(copy_boxes[cell] for cell in copy_state.box_cells)
+            copy_state._box_index = copy_boxes
+        copy_state._agent_index = None
+        copy_state._hash = None
+        copy_state._zobrist = copy_zobrist
+        copy_state.pending = None
+        copy_state.unsatisfied = copy_unsatisfied
+        copy_state.h_cache = None
 
         copy_state.parent = self
         copy_state.joint_action = joint_action[:]
@@ -87,38 +169,34 @@ class State:
         copy_state.t = self.t + 1
         return copy_state
 
+    def _intermediate(self, pending: "(Action, ...)") -> "State":
+        """
+        Returns the intermediate node of operator decomposition in which the first len(pending) agents
+        have chosen the actions in pending. Its agents and boxes are those of this (full) state, which is its
+        parent, with the pending actions applied, so that a heuristic sees the moves already chosen and can
+        evaluate it incrementally from this state like a child. Its g already counts the step, but it stays at the
+        time step of this state, whose constraints the remaining agents' actions are checked against.
+        """
+        node = self.apply_action(pending)
+        node.t = self.t
+        node.pending = pending
+        return node
+
     def is_goal_state(self, constraints) -> "bool":
-        for row in range(len(self._goals)):
-            for col in range(len(self._goals[row])):
-                goal = self._goals[row][col]
-                if "A" <= goal <= "Z" and self.boxes[row][col] != goal:
-                    return False
-                elif "0" <= goal <= "9" and not (
-                    self.agent_rows[ord(goal) - ord("0")] == row
-                    and self.agent_cols[ord(goal) - ord("0")] == col
-                ):
-                    return False
-        if constraints == set():
+        if self.unsatisfied or self.pending is not None:
+            return False
+        # The agents stay in their cells after reaching the goal, so these cells must not be constrained from now on.
+        if not constraints or self.t > constraints.max_time:
             return True
-        max_time = max(constraint[1] for constraint in constraints)
-        # print(constraints, file=sys.stderr)
-        # print(self.get_visited_locations(max_time), file=sys.stderr)
-        # print(constraints & self.get_visited_locations(max_time) == set(), file=sys.stderr)
-        return constraints & self.get_visited_locations(max_time) == set()
-
-    def get_visited_locations(self, max_time=None):
-        visited_locations = []
-        state = self
-        while state.parent is not None:
-            visited_locations.append(((state.agent_rows[0], state.agent_cols[0]), self.t))
-            state = state.parent
-        if max_time is not None:
-            last_location = visited_locations[0][0]
-            visited_locations += [(last_location, t) for t in range(self.t + 1, max_time + 1)]
-        return set(visited_locations)
+        for agent, cell in enumerate(self.agents):
+            if constraints.blocked_after(cell, self.t, agent):
+                return False
+        return True
 
     def get_expanded_states(self, constraints) -> "[State, ...]":
-        num_agents = len(self.agent_rows)
+        num_agents = len(self.agents)
+        if State.operator_decomposition and num_agents > 1:
+            return self.get_decomposed_states(constraints)
         # Determine list of applicable action for each individual agent.
         applicable_actions = [
             [
@@ -143,7 +221,9 @@ class State:
                     return expanded_states
 
             if not self.is_conflicting(joint_action):
-                expanded_states.append(self.apply_action(joint_action))
+                child = self.apply_action(joint_action)
+                if not child.is_deadlocked(self.moved_boxes(joint_action)):
+                    expanded_states.append(child)
 
             # Advance permutation.
             done = False
@@ -159,235 +239,155 @@ class State:
             # Last permutation?
             if done:
                 break
-        # print((self.agent_rows[0], self.agent_cols[0]),len(expanded_states), file = sys.stderr)
+        # print(self.agents[0], len(expanded_states), file = sys.stderr)
         # State._RNG.shuffle(expanded_states)
         return expanded_states
 
+    def get_decomposed_states(self, constraints) -> "[State, ...]":
+        """
+        Operator decomposition: instead of the full Cartesian product of the agents' actions, only the next
+        agent chooses an action, so a joint step is split into one level of intermediate nodes per agent and
+        the branching factor grows linearly with the number of agents.
+        Applicability is always checked against the full state the step started from, the parent of every
+        intermediate node, and the last agent's choice produces the child full state with the completed joint action.
+        """
+        pending = self.pending or ()
+        agent = len(pending)
+        base = self if self.pending is None else self.parent
+        last = agent == len(self.agents) - 1
+        expanded_states = []
+        for action in Action:
+            if not base.is_applicable(agent, action, constraints):
+                continue
+            joint_action = pending + (action,)
+            if base.is_conflicting(joint_action):
+                continue
+            if last:
+                child = base.apply_action(list(joint_action))
+                if not child.is_deadlocked(base.moved_boxes(joint_action)):
+                    expanded_states.append(child)
+            else:
+                expanded_states.append(base._intermediate(joint_action))
+        return expanded_states
+
     def is_applicable(self, agent: "int", action: "Action", constraints) -> "bool":
-        agent_row = self.agent_rows[agent]
-        agent_col = self.agent_cols[agent]
-        agent_color = State.agent_colors[agent]
-        destination_row = agent_row + action.agent_row_delta
-        destination_col = agent_col + action.agent_col_delta
+        transition = self.level.transitions[action][self.agents[agent]]
+        if transition is None:
+            return False
+        destination, box_from, box_to = transition
 
-        if ((destination_row, destination_col), self.t) in constraints:
+        if constraints and constraints.forbids(destination, self.t, agent):
             return False
 
         if action.type is ActionType.NoOp:
             return True
 
         elif action.type is ActionType.Move:
-            return self.is_free(destination_row, destination_col)
-
-        elif action.type is ActionType.Push:
-            destination_row = agent_row + action.agent_row_delta
-            destination_col = agent_col + action.agent_col_delta
-            return (
-                self.boxes[destination_row][destination_col] != ""
-                and self.box_colors[
-                    ord(self.boxes[destination_row][destination_col]) - ord("A")
-                ]
-                == agent_color
-                and self.is_free(
-                    destination_row + action.box_row_delta,
-                    destination_col + action.box_col_delta,
-                )
-            )
+            return self.is_free(destination)
 
-        return (
-            self.boxes[agent_row - action.box_row_delta][
-                agent_col - action.box_col_delta
-            ]
-            != ""
-            and self.box_colors[
-                ord(
-                    self.boxes[agent_row - action.box_row_delta][
-                        agent_col - action.box_col_delta
-                    ]
-                )
-                - ord("A")
-            ]
-            == agent_color
-            and self.is_free(destination_row, destination_col)
-        )
+        box = self._box_lookup().get(box_from)
+        if box is None or self.level.box_colors[ord(box) - ord("A")] != self.level.agent_colors[agent]:
+            return False
 
-    def is_conflicting(self, joint_action: "[Action, ...]") -> "bool":
-        num_agents = len(self.agent_rows)
-
-        destination_rows = [
-            None for _ in range(num_agents)
-        ]  # row of new cell to become occupied by action
-        destination_cols = [
-            None for _ in range(num_agents)
-        ]  # column of new cell to become occupied by action
-        box_rows = [
-            None for _ in range(num_agents)
-        ]  # current row of box moved by action
-        box_cols = [
-            None for _ in range(num_agents)
-        ]  # current column of box moved by action
-
-        # Collect cells to be occupied and boxes to be moved.
-        for agent in range(num_agents):
-            action = joint_action[agent]
-            agent_row = self.agent_rows[agent]
-            agent_col = self.agent_cols[agent]
+        if action.type is ActionType.Push:
+            return self.is_free(box_to)
 
-            if action.type is ActionType.NoOp:
-                pass
+        return self.is_free(destination)
 
-            elif action.type is ActionType.Move:
-                destination_rows[agent] = agent_row + action.agent_row_delta
-                destination_cols[agent] = agent_col + action.agent_col_delta
-                box_rows[agent] = agent_row  # Distinct dummy value.
-                box_cols[agent] = agent_col  # Distinct dummy value.
+    def moved_boxes(self, joint_action: "[Action, ...]") -> "[int, ...]":
+        """The cells the boxes moved by joint_action end up in."""
+        cells = []
+        for agent, action in enumerate(joint_action):
+            if action.type is ActionType.Push or action.type is ActionType.Pull:
+                cells.append(self.level.transitions[action][self.agents[agent]][2])
+        return cells
 
-        for a1 in range(num_agents):
-            if joint_action[a1] is Action.NoOp:
+    def is_deadlocked(self, cells: "[int, ...]") -> "bool":
+        """
+        True if one of the boxes at cells, off the goals of its letter, can never move again or never reach a goal,
+        and too few other boxes of its letter are left to cover its goals.
+        Such a box is on a dead square (see Level.live_cells), or frozen: it and the boxes next to it, transitively,
+        have nothing but walls and each other around them.
+        """
+        level = self.level
+        for cell in cells:
+            letter = self.box_at(cell)
+            goals = level.goals_by_letter.get(letter)
+            if goals is None or level.goal_at.get(cell) == letter:
                 continue
+            live = level.live_cells(letter)
+            if live[cell] and not self.is_frozen(cell):
+                continue
+            # Each of the other boxes of letter could still be on or reach one goal at best.
+            coverable = 0
+            for other, other_letter in zip(self.box_cells, self.box_letters):
+                if other_letter == letter and other != cell and live[other]:
+                    coverable += 1
+            if coverable < len(goals):
+                return True
+        return False
 
-            for a2 in range(a1 + 1, num_agents):
-                if joint_action[a2] is Action.NoOp:
+    def is_frozen(self, cell: "int") -> "bool":
+        """True if the box at cell is walled in by walls and boxes that are walled in too, so none can ever move."""
+        boxes = self._box_lookup()
+        neighbours = self.level.neighbours
+        seen = {cell}
+        stack = [cell]
+        while stack:
+            for neighbour in neighbours[stack.pop()]:
+                if neighbour in seen:
                     continue
+                if neighbour not in boxes:
+                    return False
+                seen.add(neighbour)
+                stack.append(neighbour)
+        return True
 
-                # Moving into same cell?
-                if (
-                    destination_rows[a1] == destination_rows[a2]
-                    and destination_cols[a1] == destination_cols[a2]
-                ):
-                    return True
+    def is_conflicting(self, joint_action: "[Action, ...]") -> "bool":
+        """
+        True if two actions of the (possibly partial) joint action move an agent or a box into the same cell
+        or move the same box. Only the actions of the first len(joint_action) agents are considered.
+        """
+        occupied = set()  # cells to become occupied by the actions
+        moved_boxes = set()  # current cells of the boxes moved by the actions
 
-        return False
+        for agent, action in enumerate(joint_action):
+            if action.type is ActionType.NoOp:
+                continue
 
-    def is_free(self, row: "int", col: "int") -> "bool":
-        return (
-            not State.walls[row][col]
-            and self.boxes[row][col] == ""
-            and self.agent_at(row, col) is None
-        )
+            destination, box_from, box_to = self.level.transitions[action][self.agents[agent]]
+            if action.type is ActionType.Push:
+                # The agent moves into the cell of the box, which no other action can enter.
+                destination = box_to
 
-    def agent_at(self, row: "int", col: "int") -> "char":
-        for agent in range(len(self.agent_rows)):
-            if self.agent_rows[agent] == row and self.agent_cols[agent] == col:
-                return chr(agent + ord("0"))
-        return None
+            # Moving into same cell?
+            if destination in occupied:
+                return True
+            occupied.add(destination)
 
-    def get_block(self, row: "int", col: "int") -> "bool":
-        if State.walls[row][col]:
-            return True
-        if not self.boxes[row][col] == "":
-            return True
-        agent_block = self.agent_at(row, col)
-        if agent_block:
-            return agent_block
-        return False
+            # Moving the same box?
+            if box_from >= 0:
+                if box_from in moved_boxes:
+                    return True
+                moved_boxes.add(box_from)
 
-    def is_conflict(self, joint_action: "[Action, ...]", time):
-        directions = ((1, 0), (-1, 0), (0, 1), (0, -1))
-        num_agents = len(joint_action)
-        blocked_agents = []
-        destination_rows = [
-            None for _ in range(num_agents)
-        ]  # row of new cell to become occupied by action
-        destination_cols = [
-            None for _ in range(num_agents)
-        ]  # column of new cell to become occupied by action
-        box_rows = [
-            None for _ in range(num_agents)
-        ]  # current row of box moved by action
-        box_cols = [
-            None for _ in range(num_agents)
-        ]  # current column of box moved by action
-
-        # Collect cells to be occupied and boxes to be moved.
-        for agent in range(num_agents):
-            action = joint_action[agent]
-            agent_row = self.agent_rows[agent]
-            agent_col = self.agent_cols[agent]
-
-            blocks = []
-            for direction in directions:
-                blocked = self.get_block(
-                    agent_row + direction[0],
-                    agent_col + direction[1],
-                )
-                blocks.append(blocked)
-            blocked_agents.append(blocks)
+        return False
 
-            if action.type is ActionType.NoOp:
-                destination_rows[agent] = agent_row
-                destination_cols[agent] = agent_col
-
-            elif action.type is ActionType.Move:
-                destination_rows[agent] = agent_row + action.agent_row_delta
-                destination_cols[agent] = agent_col + action.agent_col_delta
-
-            elif action.type is ActionType.Push:
-                destination_rows[agent] = agent_row + action.agent_row_delta
-                destination_cols[agent] = agent_col + action.agent_col_delta
-                box_rows[agent] = agent_row + action.agent_row_delta + action.box_row_delta
-                box_cols[agent] = agent_col + action.agent_col_delta + action.box_col_delta
-
-            # elif action.type is ActionType.Pull:
-            #     destination_rows[agent] = agent_row + action.agent_row_delta
-            #     destination_cols[agent] = agent_col + action.agent_col_delta
-            #     box_rows[agent] = agent_row
-            #     box_cols[agent] = agent_col
-
-        for a1 in range(num_agents):
-            for a2 in range(a1 + 1, num_agents):
-                if (
-                    destination_rows[a1] == destination_rows[a2]
-                    and destination_cols[a1] == destination_cols[a2]
-                ):
-                    conflict = Conflict.vertex(
-                        (a1, a2, (destination_rows[a1], destination_cols[a1]), time)
-                    )
-                    return conflict
-
-                elif (
-                    destination_rows[a1] == self.agent_rows[a2]
-                    and destination_cols[a1] == self.agent_cols[a2]
-                    and destination_rows[a2] == self.agent_rows[a1]
-                    and destination_cols[a2] == self.agent_cols[a1]
-                ):
-                    v1 = (self.agent_rows[a1], self.agent_cols[a1])
-                    v2 = (destination_rows[a1], destination_cols[a1])
-                    conflict = Conflict.edge((a1, a2, v1, v2, time))
-                    return conflict
-
-                elif (
-                    destination_rows[a1] == self.agent_rows[a2]
-                    and destination_cols[a1] == self.agent_cols[a2]
-                ):
-                    conflict = Conflict.follow(
-                        (a1, a2, (destination_rows[a1], destination_cols[a1]), time)
-                    )
-                    return conflict
-
-                elif (
-                    destination_rows[a2] == self.agent_rows[a1]
-                    and destination_cols[a2] == self.agent_cols[a1]
-                ):
-                    conflict = Conflict.follow(
-                        (a2, a1, (destination_rows[a2], destination_cols[a2]), time)
-                    )
-                    return conflict
-
-                elif (
-                    box_rows[a1] == self.agent_rows[a2]
-                    and box_cols[a1] == self.agent_cols[a2]
-                ):
-                    conflict = None
-                    return conflict
+    def is_free(self, cell: "int") -> "bool":
+        return (
+            not self.level.walls[cell]
+            and cell not in self._box_lookup()
+            and cell not in self._agent_lookup()
+        )
 
-        return False
+    def box_at(self, cell: "int") -> "char":
+        return self._box_lookup().get(cell, "")
 
-    def agent_at(self, row: "int", col: "int") -> "char":
-        for agent in range(len(self.agent_rows)):
-            if self.agent_rows[agent] == row and self.agent_cols[agent] == col:
-                return chr(agent + ord("0"))
-        return None
+    def agent_at(self, cell: "int") -> "char":
+        agent = self._agent_lookup().get(cell)
+        if agent is None:
+            return None
+        return chr(agent + ord("0"))
 
     def extract_plan(self) -> "[Action, ...]":
         plan = [None for _ in range(self.t)]
@@ -398,18 +398,11 @@ class State:
         return plan
 
     def __hash__(self):
+        # Walls, goals and colors are in the Level shared by every state of a search, so only the
+        # incrementally maintained Zobrist key of the agents and boxes, the time step and, for the
+        # intermediate nodes of operator decomposition, the actions chosen so far are hashed.
         if self._hash is None:
-            prime = 31
-            _hash = 1
-            _hash = _hash * prime + hash(tuple(self.agent_rows))
-            _hash = _hash * prime + hash(tuple(self.agent_cols))
-            _hash = _hash * prime + hash(tuple(State.agent_colors))
-            _hash = _hash * prime + hash(tuple(tuple(row) for row in self.boxes))
-            _hash = _hash * prime + hash(tuple(self.box_colors))
-            _hash = _hash * prime + hash(tuple(tuple(row) for row in self._goals))
-            _hash = _hash * prime + hash(tuple(tuple(row) for row in State.walls))
-            _hash = _hash * prime + hash(self.t)
-            self._hash = _hash
+            self._hash = hash((self._zobrist, self.t, self.pending))
         return self._hash
 
     def __eq__(self, other):
@@ -417,32 +410,29 @@ class State:
             return True
         if not isinstance(other, State):
             return False
-        if self.agent_rows != other.agent_rows:
-            return False
-        if self.agent_cols != other.agent_cols:
+        if self._zobrist != other._zobrist:
             return False
-        if State.agent_colors != other.agent_colors:
+        if self.agents != other.agents:
             return False
-        if State.walls != other.walls:
+        if self.box_cells != other.box_cells:
             return False
-        if self.boxes != other.boxes:
-            return False
-        if self.box_colors != other.box_colors:
-            return False
-        if self._goals != other._goals:
+        if self.box_letters != other.box_letters:
             return False
         if self.t != other.t:
             return False  ##### makes MAANDERS05 7 sec faster than with timeState??
+        if self.pending != other.pending:
+            return False
         return True
 
     def __repr__(self):
         lines = []
-        for row in range(len(self.boxes)):
+        for row in range(self.level.num_rows):
             line = []
-            for col in range(len(self.boxes[row])):
-                if self.boxes[row][col] != '': line.append(self.boxes[row][col])
-                elif State.walls[row][col] is True: line.append('+')
-                elif self.agent_at(row, col) is not None: line.append(self.agent_at(row, col))
+            for col in range(self.level.num_cols):
+                cell = self.level.cell(row, col)
+                if self.box_at(cell) != '': line.append(self.box_at(cell))
+                elif self.level.walls[cell]: line.append('+')
+                elif self.agent_at(cell) is not None: line.append(self.agent_at(cell))
                 else: line.append(' ')
             lines.append(''.join(line))
         return '\n'.join(lines)
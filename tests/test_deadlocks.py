@@ -0,0 +1,103 @@
+"""
+Exhaustive checks that deadlock pruning (State.is_deadlocked) never changes whether a level can be solved: on every
+small level, no state it prunes may have a path to the goal.
+"""
+import os
+import sys
+from collections import deque
+from itertools import product
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "searchclient"))
+
+from action import Action, ActionType
+from color import Color
+from level import Level
+from state import State
+
+
+def make_level(rows, goal_cells, letter="A"):
+    """rows are the interior rows of the level ('+' for walls), which gets a wall border."""
+    walls = [[True] * (len(rows[0]) + 2)]
+    walls += [[True] + [c == "+" for c in row] + [True] for row in rows]
+    walls += [[True] * (len(rows[0]) + 2)]
+    goals = [["" for _ in line] for line in walls]
+    for row, col in goal_cells:
+        goals[row][col] = letter
+    agent_colors = [Color.Blue] + [None] * 9
+    box_colors = [None] * 26
+    box_colors[ord(letter) - ord("A")] = Color.Blue
+    return Level(walls, goals, agent_colors, box_colors)
+
+
+def successors(state):
+    """The children of a single-agent state, without any pruning."""
+    for action in Action:
+        if state.is_applicable(0, action, None):
+            yield action, state.apply_action([action])
+
+
+def check_level(level, num_boxes, letter="A"):
+    """Checks every placement of the agent and num_boxes boxes of letter in level."""
+    free = [cell for cell in range(level.num_cells) if not level.walls[cell]]
+    states = {}
+    for cells in product(free, repeat=num_boxes + 1):
+        agent, boxes = cells[0], cells[1:]
+        if len(set(cells)) != len(cells) or list(boxes) != sorted(boxes):
+            continue
+        state = State(level, [agent], {box: letter for box in boxes})
+        states[(state.agents, state.box_cells)] = state
+
+    # The states with a path to the goal, found backwards from the goal states.
+    predecessors = {key: [] for key in states}
+    for key, state in states.items():
+        for _, child in successors(state):
+            predecessors[(child.agents, child.box_cells)].append(key)
+    solvable = {key for key, state in states.items() if state.unsatisfied == 0}
+    queue = deque(solvable)
+    while queue:
+        for key in predecessors[queue.popleft()]:
+            if key not in solvable:
+                solvable.add(key)
+                queue.append(key)
+
+    for key, state in states.items():
+        for action, child in successors(state):
+            if action.type is ActionType.Move or action.type is ActionType.NoOp:
+                continue
+            child_key = (child.agents, child.box_cells)
+            if child_key in solvable and child.is_deadlocked(state.moved_boxes([action])):
+                rows = "/".join(
+                    "".join("+" if level.walls[row * level.num_cols + col] else " " for col in range(level.num_cols))
+                    for row in range(level.num_rows)
+                )
+                raise AssertionError(f"{action} prunes a solvable state: {rows}, agent and boxes {child_key}")
+
+
+def wall_patterns(num_rows, num_cols):
+    for mask in range(1 << (num_rows * num_cols)):
+        yield [
+            "".join("+" if mask >> (row * num_cols + col) & 1 else " " for col in range(num_cols))
+            for row in range(num_rows)
+        ]
+
+
+def test_corner_push():
+    # The box must be pushed round the corner at (2, 1) to reach its goal below.
+    check_level(make_level(["+   ", "    ", " +  "], [(3, 1)]), 1)
+
+
+def test_one_box():
+    for rows in wall_patterns(3, 3):
+        for row, col in product(range(3), repeat=2):
+            if rows[row][col] != "+":
+                check_level(make_level(rows, [(row + 1, col + 1)]), 1)
+
+
+def test_two_boxes():
+    for rows in wall_patterns(2, 3):
+        free = [(row + 1, col + 1) for row in range(2) for col in range(3) if rows[row][col] != "+"]
+        for goal in free:
+            check_level(make_level(rows, [goal]), 2)
+        for first, second in product(free, repeat=2):
+            if first < second:
+                check_level(make_level(rows, [first, second]), 2)
@@ -0,0 +1,74 @@
+"""
+Checks that the optimal strategies find plans as short as a breadth-first search on single-agent levels.
+"""
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+from collections import deque
+from functools import lru_cache
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(__file__), "..")
+CLIENT = os.path.join(ROOT, "searchclient", "searchclient.py")
+sys.path.insert(0, os.path.join(ROOT, "searchclient"))
+
+from action import Action
+
+_spec = importlib.util.spec_from_file_location("client", CLIENT)
+client = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(client)
+
+
+def level_path(name):
+    return os.path.join(ROOT, "levels", "warmup", name + ".lvl")
+
+
+@lru_cache(maxsize=None)
+def shortest_plan_length(name):
+    """
+    Breadth-first search over the agent and box cells alone: with a single agent and no constraints, waiting
+    never helps, so the time step that tells the client's states apart can be left out.
+    """
+    with open(level_path(name)) as level:
+        initial_state = client.SearchClient.parse_level(level)
+    if initial_state.unsatisfied == 0:
+        return 0
+    seen = {(initial_state.agents, initial_state.box_cells)}
+    queue = deque([(initial_state, 0)])
+    while queue:
+        state, length = queue.popleft()
+        for action in Action:
+            if not state.is_applicable(0, action, None):
+                continue
+            child = state.apply_action([action])
+            if child.unsatisfied == 0:
+                return length + 1
+            key = (child.agents, child.box_cells)
+            if key not in seen:
+                seen.add(key)
+                # Only the length of the plan is needed, so the chain of parents can go.
+                child.parent = None
+                queue.append((child, length + 1))
+    return None
+
+
+def plan_length(name, strategy):
+    with open(level_path(name)) as level:
+        result = subprocess.run(
+            [sys.executable, CLIENT, strategy, "--cache-dir", ""],
+            stdin=level,
+            capture_output=True,
+            text=True,
+            timeout=120,
+        )
+    found = re.search(r"Found solution of length (\d+)\.", result.stderr)
+    return int(found.group(1)) if found else None
+
+
+@pytest.mark.parametrize("name", ["SAD1", "SAD2"])
+@pytest.mark.parametrize("strategy", ["-astar", "-idastar"])
+def test_optimal_plan_length(name, strategy):
+    assert plan_length(name, strategy) == shortest_plan_length(name)